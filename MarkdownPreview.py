@@ -11,6 +11,10 @@ import json
 import time
 import codecs
 import cgi
+import hashlib
+import threading
+import socket
+import io
 import yaml
 # import logging as log
 # from logging import (debug as print, error as eprint, info as iprint )
@@ -33,29 +37,28 @@ refFile = ""
 if is_ST3():
     from .helper import INSTALLED_DIRECTORY
     from . import desktop
-    from .markdown_settings import Settings
+    from .markdown_settings import Settings, get_snapshot
     from .markdown_wrapper import StMarkdown as Markdown
-    from urllib.request import urlopen, url2pathname, pathname2url
+    from urllib.request import url2pathname, pathname2url, urlopen, Request, getproxies, proxy_bypass
     from urllib.parse import urlparse, urlunparse
     from urllib.error import HTTPError, URLError
     from urllib.parse import quote
+    import http.client as httplib
+    from queue import Queue, Full
     from .markdown.extensions import codehilite
 
-    def Request(url, data, headers):
-        ''' Adapter for urllib2 used in ST2 '''
-        import urllib.request
-        return urllib.request.Request(url, data=data, headers=headers, method='POST')
-
     unicode_str = str
 
 else:
     from helper import INSTALLED_DIRECTORY
     import desktop
-    from markdown_settings import Settings
+    from markdown_settings import Settings, get_snapshot
     from markdown_wrapper import StMarkdown as Markdown
-    from urllib2 import Request, urlopen, HTTPError, URLError
-    from urllib import quote, url2pathname, pathname2url
+    from urllib2 import HTTPError, URLError, Request, urlopen
+    from urllib import quote, url2pathname, pathname2url, getproxies, proxy_bypass
     from urlparse import urlparse, urlunparse
+    import httplib
+    from Queue import Queue, Full
     import markdown.extensions.codehilite as codehilite
 
     unicode_str = unicode
@@ -68,6 +71,8 @@ except:
 
 _CANNOT_CONVERT = u'cannot convert markdown'
 
+GITHUB_API_URL = 'https://api.github.com/markdown'
+
 PATH_EXCLUDE = tuple(
     [
         'file://', 'https://', 'http://', '/', '#',
@@ -89,24 +94,347 @@ DEFAULT_EXT = [
 
 __FILE__ = os.path.basename(__file__)
 
+# Settings that change the compiled document.  They are part of the render cache key.
+RENDER_SETTINGS = (
+    'css', 'allow_css_overrides', 'markdown_filetypes', 'js', 'enable_mathjax', 'enable_uml',
+    'html_template', 'html_simple', 'skip_default_stylesheet', 'strip_yaml_front_matter',
+    'image_path_conversion', 'file_path_conversions', 'path_tempfile', 'strip_critic_marks',
+    'github_mode', 'github_oauth_token', 'github_inject_header_ids', 'markdown_binary_map',
+    'enabled_extensions', 'enable_highlight', 'enable_pygments', 'guess_language',
+    'highlight_max_lines', 'highlight_max_bytes', 'highlight_max_document_bytes',
+    'image_base64_max_size', 'github_api_url', 'github_chunk_size', 'markdown_binary_workers',
+    'chapter_compile', 'inline_diagram', 'inline_diagram_export_dir',
+    'inline_diagram_default_style', 'code_import', 'code_import_default_fancy_marker'
+)
+
+
+def write_atomic(path, data):
+    '''
+    Write bytes to path through a temporary file in the same directory
+    which is then renamed, so readers never see a half written file.
+    '''
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, temp = tempfile.mkstemp(prefix='.%s.' % os.path.basename(path), dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(temp, 0o644)
+        if is_ST3():
+            os.replace(temp, path)
+        else:
+            if sublime.platform() == "windows" and os.path.exists(path):
+                os.remove(path)
+            os.rename(temp, path)
+    except Exception:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+
+class PreviewFiles(object):
+    '''
+    Temp preview files of the views.
+
+    The path of a view's file is resolved once, and a file is only written
+    when the html changed.  It is written to a temporary file which is
+    renamed, so a browser never reads it half written.
+
+    Files are tracked per view and removed when the view is closed.  Past
+    preview_files_max_count files or preview_files_max_size MB the least
+    recently written files are removed.  Every file is stamped with the
+    change count of the buffer it was rendered from: a render older than
+    the file is not written, and files left over by another session (view
+    ids are reused) are not taken for previews.
+    '''
+
+    def __init__(self):
+        self.paths = {}
+        self.files = {}
+        self.tick = 0
+        self.lock = threading.Lock()
+
+    def get_path(self, view):
+        ''' return a permanent full path of the temp markdown preview file '''
+        path_tempfile = get_snapshot().get('path_tempfile')
+        key = (view.id(), view.file_name(), path_tempfile)
+        path = self.paths.get(key)
+        if path is not None:
+            return path
+
+        tmp_filename = '%s.html' % view.id()
+        tmp_dir = tempfile.gettempdir()
+        if path_tempfile:
+            if os.path.isabs(path_tempfile):  # absolute path or not
+                tmp_dir = path_tempfile
+            else:
+                tmp_dir = os.path.join(os.path.dirname(view.file_name()), path_tempfile)
+
+        if not os.path.isdir(tmp_dir):  # create dir if not exsits
+            os.makedirs(tmp_dir)
+
+        path = self.paths[key] = os.path.join(tmp_dir, tmp_filename)
+        return path
+
+    def has_file(self, view):
+        ''' check if the view's preview file was written by this session '''
+        path = self.get_path(view)
+        with self.lock:
+            entry = self.files.get(path)
+        return entry is not None and entry['view'] == view.id() and os.path.isfile(path)
+
+    def write(self, path, html, view_id, change_count=None):
+        '''
+        write html to path unless the file already has it or was rendered
+        from a newer buffer, return True if written
+        '''
+        data = html.encode('utf-8')
+        digest = hashlib.sha1(data).hexdigest()
+        signature = file_signature(path)
+        # The entry may be evicted by other threads, check and update it under the lock
+        with self.lock:
+            entry = self.files.get(path)
+            if entry is not None and entry['view'] == view_id:
+                if (
+                    change_count is not None and entry['change_count'] is not None and
+                    change_count < entry['change_count']
+                ):
+                    return False
+                if entry['hash'] == digest and entry['signature'] == signature:
+                    entry['change_count'] = change_count
+                    return False
+
+        write_atomic(path, data)
+
+        with self.lock:
+            self.tick += 1
+            self.files[path] = {
+                'view': view_id,
+                'hash': digest,
+                'signature': file_signature(path),
+                'size': len(data),
+                'change_count': change_count,
+                'used': self.tick
+            }
+        self.evict(path)
+        return True
+
+    def remove(self, path):
+        ''' delete a tracked file '''
+        with self.lock:
+            entry = self.files.pop(path, None)
+        if entry is not None:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def evict(self, keep):
+        ''' remove the least recently written files until the limits are met '''
+        settings = get_snapshot()
+        max_count = settings.get('preview_files_max_count', 50)
+        max_size = settings.get('preview_files_max_size', 100) * 1024 * 1024
+        with self.lock:
+            count = len(self.files)
+            size = sum(entry['size'] for entry in self.files.values())
+            if (not max_count or count <= max_count) and (not max_size or size <= max_size):
+                return
+            paths = sorted(self.files, key=lambda k: self.files[k]['used'])
+        for path in paths:
+            if path == keep:
+                continue
+            if (not max_count or count <= max_count) and (not max_size or size <= max_size):
+                break
+            with self.lock:
+                entry = self.files.get(path)
+            if entry is not None:
+                self.remove(path)
+                count -= 1
+                size -= entry['size']
+
+    def forget(self, view_id):
+        ''' remove the files of a closed view '''
+        with self.lock:
+            paths = [path for path, entry in self.files.items() if entry['view'] == view_id]
+            for key in [key for key in self.paths if key[0] == view_id]:
+                del self.paths[key]
+        for path in paths:
+            self.remove(path)
+
+
+preview_files = PreviewFiles()
+
+
 def getTempMarkdownPreviewPath(view):
     ''' return a permanent full path of the temp markdown preview file '''
+    return preview_files.get_path(view)
+
 
-    settings = sublime.load_settings('MarkdownPreview.sublime-settings')
+def run_async(callback):
+    '''
+    run callback on the worker thread (ST3).  The ST2 API must not be used
+    off the main thread, so there the callback is only deferred.
+    '''
+    if is_ST3():
+        sublime.set_timeout_async(callback, 0)
+    else:
+        sublime.set_timeout(callback, 0)
 
-    tmp_filename = '%s.html' % view.id()
-    tmp_dir = tempfile.gettempdir()
-    if settings.get('path_tempfile'):
-        if os.path.isabs(settings.get('path_tempfile')):  # absolute path or not
-            tmp_dir = settings.get('path_tempfile')
+
+class CompileCancelled(Exception):
+    ''' Raised by a compiler when its preview request has been superseded. '''
+
+
+class PreviewJob(object):
+    '''
+    A preview request for one view.  Creating a new job for a view
+    supersedes (cancels) every older job of the same view.
+    '''
+    _generations = {}
+    _lock = threading.Lock()
+
+    def __init__(self, view_id):
+        self.view_id = view_id
+        with self._lock:
+            self.generation = self._generations.get(view_id, 0) + 1
+            self._generations[view_id] = self.generation
+
+    def cancelled(self):
+        return self._generations.get(self.view_id) != self.generation
+
+    @classmethod
+    def latest(cls, view_id):
+        ''' return the generation of the newest job for the view '''
+        return cls._generations.get(view_id, 0)
+
+
+class ViewSnapshot(object):
+    '''
+    Copy of the view data the compilers need.  Taken on the UI thread,
+    safe to use from a worker thread after the buffer has changed.
+    '''
+
+    def __init__(self, view):
+        self._id = view.id()
+        self._file_name = view.file_name()
+        self._name = view.name()
+        self._change_count = view.change_count()
+        self.text = view.substr(sublime.Region(0, view.size()))
+        sel = view.sel()
+        self.selection = view.substr(sel[0]) if len(sel) else ''
+        window = view.window()
+        if window is not None and hasattr(window, 'extract_variables'):
+            self.variables = window.extract_variables()
         else:
-            tmp_dir = os.path.join(os.path.dirname(view.file_name()), settings.get('path_tempfile'))
+            self.variables = {}
+
+    @classmethod
+    def from_file(cls, file_name):
+        ''' Snapshot of a file on disk, for files that are not open in a view. '''
+        snapshot = cls.__new__(cls)
+        snapshot._id = None
+        snapshot._file_name = file_name
+        snapshot._name = ''
+        snapshot._change_count = None
+        snapshot.text = load_utf8(file_name)
+        snapshot.selection = ''
+        snapshot.variables = {
+            'file': file_name,
+            'file_path': os.path.dirname(file_name),
+            'file_name': os.path.basename(file_name),
+            'file_base_name': splitext(os.path.basename(file_name))[0]
+        }
+        return snapshot
+
+    def id(self):
+        return self._id
+
+    def file_name(self):
+        return self._file_name
+
+    def name(self):
+        return self._name
+
+    def change_count(self):
+        return self._change_count
+
+
+def file_signature(path):
+    ''' return (mtime, size) of path, or None if it does not exist '''
+    try:
+        st = os.stat(path)
+    except (OSError, TypeError, ValueError):
+        return None
+    return (st.st_mtime, st.st_size)
+
+
+class RenderCache(object):
+    '''
+    LRU cache of compiled documents, shared by all views.  An entry is only
+    returned while the files it was compiled from are unchanged.
+    '''
 
-    if not os.path.isdir(tmp_dir):  # create dir if not exsits
-        os.makedirs(tmp_dir)
+    def __init__(self, max_size=32 * 1024 * 1024):
+        self.max_size = max_size
+        self.size = 0
+        self.tick = 0
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def resize(self, max_size):
+        with self.lock:
+            self.max_size = max_size
+            self.evict()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None:
+            return None
+        for path, signature in entry['dependencies'].items():
+            if file_signature(path) != signature:
+                self.discard(key)
+                return None
+        with self.lock:
+            self.tick += 1
+            entry['used'] = self.tick
+        return entry['value']
+
+    def set(self, key, value, dependencies, size):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old['size']
+            if size > self.max_size:
+                return
+            self.tick += 1
+            self.entries[key] = {
+                'value': value,
+                'dependencies': dependencies,
+                'size': size,
+                'used': self.tick
+            }
+            self.size += size
+            self.evict()
+
+    def discard(self, key):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old['size']
+
+    def evict(self):
+        ''' drop the least recently used entries until the cache fits (lock held) '''
+        if self.size <= self.max_size:
+            return
+        for key in sorted(self.entries, key=lambda k: self.entries[k]['used']):
+            self.size -= self.entries.pop(key)['size']
+            if self.size <= self.max_size:
+                break
 
-    tmp_fullpath = os.path.join(tmp_dir, tmp_filename)
-    return tmp_fullpath
+
+render_cache = RenderCache()
 
 
 def save_utf8(filename, text):
@@ -114,6 +442,17 @@ def save_utf8(filename, text):
         f.write(text)
 
 
+def save_utf8_if_changed(filename, text):
+    ''' save text unless the file already has that content, return True if it was written '''
+    try:
+        if load_utf8(filename) == text:
+            return False
+    except (IOError, OSError, UnicodeDecodeError):
+        pass
+    save_utf8(filename, text)
+    return True
+
+
 def load_utf8(filename):
     with codecs.open(filename, 'r', encoding='utf-8') as f:
         return f.read()
@@ -134,6 +473,318 @@ def load_resource(name):
         return ''
 
 
+def resource_signature(name):
+    '''
+    return the signature of a file within the package root folder.  None if
+    the package is not unpacked; packed resources only change with an
+    upgrade, which reloads the plugin anyway.
+    '''
+    return file_signature(os.path.join(sublime.packages_path(), INSTALLED_DIRECTORY, os.path.normpath(name)))
+
+
+class ResourceCache(object):
+    '''
+    Cache for stylesheets, scripts and templates and the html fragments
+    built from them.  Entries are validated with the file's mtime and size,
+    so an unchanged asset costs a stat call.
+    '''
+
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, key, signature, build):
+        ''' return the cached value of key, calling build if signature changed '''
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == signature:
+            return entry[1]
+        value = build()
+        self.entries[key] = (signature, value)
+        return value
+
+    def file(self, filename, template=u'%s'):
+        ''' return the contents of a file, formatted with template '''
+        signature = file_signature(filename)
+        if signature is None:
+            return template % load_utf8(filename)
+        return self.get(('file', filename, template), signature, lambda: template % load_utf8(filename))
+
+    def resource(self, name, template=u'%s'):
+        ''' return the contents of a package resource, formatted with template '''
+        key = ('resource', name, template)
+        signature = resource_signature(name)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == signature:
+            return entry[1]
+        contents = load_resource(name)
+        value = template % contents
+        if contents:
+            # A failed load returns '', it is retried on the next call
+            self.entries[key] = (signature, value)
+        return value
+
+
+resource_cache = ResourceCache()
+
+
+class Base64Cache(object):
+    '''
+    Cache of base64 encoded images.
+
+    Images are looked up by path and validated with the file's mtime and
+    size.  The encoded data is stored by content hash, so identical images
+    found under different paths are encoded once and share one data uri.
+    The cache is flushed once it holds more than max_size bytes.
+    '''
+
+    def __init__(self, max_size=32 * 1024 * 1024):
+        self.max_size = max_size
+        self.size = 0
+        self.paths = {}
+        self.uris = {}
+        self.lock = threading.Lock()
+
+    def get(self, path, signature, mime):
+        ''' return the data uri of the image at path '''
+        import base64
+
+        with self.lock:
+            entry = self.paths.get(path)
+            if entry is not None and entry[0] == signature:
+                uri = self.uris.get(entry[1])
+                if uri is not None:
+                    return uri
+
+        with open(path, "rb") as f:
+            data = f.read()
+        digest = hashlib.sha1(data).hexdigest()
+
+        with self.lock:
+            uri = self.uris.get(digest)
+            if uri is None:
+                uri = "data:%s;base64,%s" % (mime, base64.b64encode(data).decode('ascii'))
+                if self.size + len(uri) > self.max_size:
+                    self.paths.clear()
+                    self.uris.clear()
+                    self.size = 0
+                self.uris[digest] = uri
+                self.size += len(uri)
+            self.paths[path] = (signature, digest)
+        return uri
+
+
+base64_cache = Base64Cache()
+
+
+class GithubClient(object):
+    '''
+    Client for the GitHub markdown API.
+
+    Connections are kept alive and reused by each thread.  When a proxy
+    is configured (environment or system settings) requests go through
+    urlopen instead, which honors it.  Responses are cached by text, mode
+    and token; an entry older than max_age is revalidated with its ETag.
+    The rate limit reported by GitHub is tracked, and while it is
+    exhausted cached entries are served as they are.
+    '''
+
+    def __init__(self, max_entries=64, timeout=60):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.entries = {}
+        self.tick = 0
+        self.rate_limit = None
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def get_key(self, text, mode, token):
+        ''' cache key; the token itself is not kept, only its hash '''
+        identity = hashlib.sha256(token.encode('utf-8')).hexdigest() if token else ''
+        return hashlib.sha256(u'\n'.join((mode, identity, text)).encode('utf-8')).hexdigest()
+
+    def is_limited(self):
+        ''' check if the rate limit is exhausted '''
+        rate_limit = self.rate_limit
+        return rate_limit is not None and rate_limit[0] <= 0 and rate_limit[1] > time.time()
+
+    def update_rate_limit(self, headers):
+        try:
+            self.rate_limit = (
+                int(headers['x-ratelimit-remaining']), int(headers['x-ratelimit-reset'])
+            )
+        except (KeyError, ValueError):
+            pass
+
+    def get_connection(self, scheme, netloc):
+        ''' return the keep-alive connection of this thread to netloc '''
+        connections = getattr(self.local, 'connections', None)
+        if connections is None:
+            connections = self.local.connections = {}
+        connection = connections.get((scheme, netloc))
+        if connection is None:
+            if scheme == 'http':
+                connection = httplib.HTTPConnection(netloc, timeout=self.timeout)
+            elif hasattr(httplib, 'HTTPSConnection'):
+                connection = httplib.HTTPSConnection(netloc, timeout=self.timeout)
+            else:
+                raise URLError('SSL is not available')
+            connections[(scheme, netloc)] = connection
+        return connection
+
+    def use_proxy(self, scheme, netloc):
+        ''' check if requests to netloc go through a proxy '''
+        if scheme not in getproxies():
+            return False
+        try:
+            return not proxy_bypass(netloc.rsplit('@', 1)[-1].split(':')[0])
+        except Exception:
+            return True
+
+    def request_urlopen(self, url, body, headers):
+        ''' POST body to url with urlopen, which supports proxies '''
+        try:
+            response = urlopen(Request(url, body, headers), timeout=self.timeout)
+            status, reason = 200, 'OK'
+        except HTTPError as e:
+            response = e
+            status, reason = e.code, e.msg
+        try:
+            return (
+                status, reason,
+                dict((k.lower(), v) for k, v in response.info().items()),
+                response.read()
+            )
+        finally:
+            response.close()
+
+    def request(self, url, body, headers):
+        '''
+        POST body to url, return status, reason, headers and body of the
+        response.  A request failing on a reused connection, which the
+        server may have closed in the meantime, is sent once more.
+        '''
+        scheme, netloc, path, params, query = urlparse(url)[:5]
+        if self.use_proxy(scheme, netloc):
+            return self.request_urlopen(url, body, headers)
+        path = urlunparse(('', '', path or '/', params, query, ''))
+        for attempt in range(2):
+            connection = self.get_connection(scheme, netloc)
+            try:
+                connection.request('POST', path, body, headers)
+                response = connection.getresponse()
+                return (
+                    response.status, response.reason,
+                    dict((k.lower(), v) for k, v in response.getheaders()),
+                    response.read()
+                )
+            except (httplib.HTTPException, socket.error) as e:
+                connection.close()
+                del self.local.connections[(scheme, netloc)]
+                if attempt:
+                    raise URLError(e)
+
+    def convert(self, url, text, mode, token=None, max_age=3600):
+        ''' convert text to html, raises HTTPError and URLError like urlopen '''
+        key = self.get_key(text, mode, token)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.tick += 1
+                entry[3] = self.tick
+        if entry is not None and (time.time() - entry[2] < max_age or self.is_limited()):
+            return entry[0]
+
+        headers = {'Content-Type': 'application/json'}
+        if token:
+            headers['Authorization'] = "token %s" % token
+        if entry is not None and entry[1]:
+            headers['If-None-Match'] = entry[1]
+        data = json.dumps({"text": text, "mode": mode}).encode('utf-8')
+        status, reason, response_headers, body = self.request(url, data, headers)
+        self.update_rate_limit(response_headers)
+
+        if entry is not None and (status == 304 or (status in (403, 429) and self.is_limited())):
+            html = entry[0]
+            etag = entry[1]
+        elif status != 200:
+            raise HTTPError(url, status, reason, response_headers, io.BytesIO(body))
+        else:
+            html = body.decode('utf-8')
+            etag = response_headers.get('etag')
+
+        with self.lock:
+            if key not in self.entries and len(self.entries) >= self.max_entries:
+                # Drop the least recently used entry
+                del self.entries[min(self.entries, key=lambda k: self.entries[k][3])]
+            self.tick += 1
+            self.entries[key] = [html, etag, time.time(), self.tick]
+        return html
+
+
+github_client = GithubClient()
+
+
+class WorkerPool(object):
+    '''
+    Daemon threads that live as long as the plugin and run calls for
+    whoever needs them.  Because the threads persist, their thread local
+    state does too, like the keep-alive connections of GithubClient.
+    '''
+
+    def __init__(self):
+        self.queue = Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def grow(self, count):
+        ''' start threads until there are count of them '''
+        with self.lock:
+            while len(self.threads) < count:
+                thread = threading.Thread(target=self.run)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def run(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+            func, item, index, results, errors, done = task
+            try:
+                # Once a call failed, the remaining items are not needed
+                if not errors:
+                    results[index] = func(item)
+            except Exception:
+                errors.append(sys.exc_info()[1])
+            done.release()
+
+    def map(self, func, items, workers):
+        '''
+        Call func for every item with up to workers threads, return the
+        results in order.  The first exception raised is raised again.
+        '''
+        self.grow(workers)
+        results = [None] * len(items)
+        errors = []
+        done = threading.Semaphore(0)
+        for index, item in enumerate(items):
+            self.queue.put((func, item, index, results, errors, done))
+        for _ in items:
+            done.acquire()
+        if errors:
+            raise errors[0]
+        return results
+
+    def stop(self):
+        with self.lock:
+            for _ in self.threads:
+                self.queue.put(None)
+            self.threads = []
+
+
+github_pool = WorkerPool()
+
+
 def exists_resource(resource_file_path):
     filename = os.path.join(os.path.dirname(sublime.packages_path()), resource_file_path)
     return os.path.isfile(filename)
@@ -174,6 +825,12 @@ def get_references(file_name, encoding="utf-8"):
     return text
 
 
+RE_URL_PATH = re.compile(r'file|[A-Za-z]')
+RE_URL_WIN_DRIVE = re.compile(r"[A-Za-z]:?")
+RE_URL = re.compile('(http|ftp)s?|data|mailto|tel|news')
+RE_WIN_DRIVE_PATH = re.compile(r"(^(?P<drive>[A-Za-z]{1}):(?:\\|/))")
+
+
 def parse_url(url):
     """
     Parse the url and
@@ -181,9 +838,6 @@ def parse_url(url):
     (as we will call anything else) a url
     """
 
-    RE_PATH = re.compile(r'file|[A-Za-z]')
-    RE_WIN_DRIVE = re.compile(r"[A-Za-z]:?")
-    RE_URL = re.compile('(http|ftp)s?|data|mailto|tel|news')
     is_url = False
     is_absolute = False
     scheme, netloc, path, params, query, fragment = urlparse(url)
@@ -194,15 +848,15 @@ def parse_url(url):
     elif scheme == '' and netloc == '' and path == '':
         # Maybe just a url fragment
         is_url = True
-    elif scheme == '' or RE_PATH.match(scheme):
+    elif scheme == '' or RE_URL_PATH.match(scheme):
         if sublime.platform() == "windows":
-            if scheme == 'file' and RE_WIN_DRIVE.match(netloc):
+            if scheme == 'file' and RE_URL_WIN_DRIVE.match(netloc):
                 # file://c:/path
                 path = netloc + path
                 netloc = ''
                 scheme = ''
                 is_absolute = True
-            elif RE_WIN_DRIVE.match(scheme):
+            elif RE_URL_WIN_DRIVE.match(scheme):
                 # c:/path
                 path = '%s:%s' % (scheme, path)
                 scheme = ''
@@ -225,10 +879,9 @@ def parse_url(url):
     return (scheme, netloc, path, params, query, fragment, is_url, is_absolute)
 
 
-def repl_relative(m, base_path, relative_path):
+def repl_relative(m, base_path, relative_path, exists=os.path.exists):
     """ Replace path with relative path """
 
-    RE_WIN_DRIVE_PATH = re.compile(r"(^(?P<drive>[A-Za-z]{1}):(?:\\|/))")
     link = m.group(0)
     try:
         scheme, netloc, path, params, query, fragment, is_url, is_absolute = parse_url(m.group('path')[1:-1])
@@ -241,9 +894,9 @@ def repl_relative(m, base_path, relative_path):
             if (not is_absolute):
                 # Convert current relative path to absolute
                 temp = os.path.normpath(os.path.join(base_path, path))
-                if os.path.exists(temp):
+                if exists(temp):
                     abs_path = temp.replace("\\", "/")
-            elif os.path.exists(path):
+            elif exists(path):
                 abs_path = path
 
             if abs_path is not None:
@@ -280,7 +933,7 @@ def repl_relative(m, base_path, relative_path):
     return link
 
 
-def repl_absolute(m, base_path):
+def repl_absolute(m, base_path, exists=os.path.exists):
     """ Replace path with absolute path """
     link = m.group(0)
 
@@ -290,7 +943,7 @@ def repl_absolute(m, base_path):
         if (not is_absolute and not is_url):
             path = url2pathname(path)
             temp = os.path.normpath(os.path.join(base_path, path))
-            if os.path.exists(temp):
+            if exists(temp):
                 path = pathname2url(temp.replace("\\", "/"))
                 link = '%s"%s"' % (m.group('name'), urlunparse((scheme, netloc, path, params, query, fragment)))
     except Exception:
@@ -300,76 +953,287 @@ def repl_absolute(m, base_path):
     return link
 
 
-class CriticDump(object):
-    RE_CRITIC = re.compile(
-        r'''
-            ((?P<open>\{)
-                (?:
-                    (?P<ins_open>\+{2})(?P<ins_text>.*?)(?P<ins_close>\+{2})
-                  | (?P<del_open>\-{2})(?P<del_text>.*?)(?P<del_close>\-{2})
-                  | (?P<mark_open>\={2})(?P<mark_text>.*?)(?P<mark_close>\={2})
-                  | (?P<comment>(?P<com_open>\>{2})(?P<com_text>.*?)(?P<com_close>\<{2}))
-                  | (?P<sub_open>\~{2})(?P<sub_del_text>.*?)(?P<sub_mid>\~\>)(?P<sub_ins_text>.*?)(?P<sub_close>\~{2})
-                )
-            (?P<close>\})|.)
-        ''',
-        re.MULTILINE | re.DOTALL | re.VERBOSE
+RE_TAG_HTML = r'''(?xus)
+(?:
+    (?P<comments>(\r?\n?\s*)<!--[\s\S]*?-->(\s*)(?=\r?\n)|<!--[\s\S]*?-->)|
+    (?P<open><(?P<tag>%s))
+    (?P<attr>(?:\s+[\w\-:]+(?:\s*=\s*(?:"[^"]*"|'[^']*'))?)*)
+    (?P<close>\s*(?:\/?)>)
+)
+'''
+
+# A valid attribute string, as matched by the attr group above
+RE_TAG_ATTRS = re.compile(r'''(?:\s+[\w\-:]+(?:\s*=\s*(?:"[^"]*"|'[^']*'))?)*$''', re.UNICODE)
+
+RE_TAG_LINK_ATTR = re.compile(
+    r'''(?xus)
+    (?P<attr>
+        (?:
+            (?P<name>\s+(?:href|src)\s*=\s*)
+            (?P<path>"[^"]*"|'[^']*')
+        )
     )
+    '''
+)
 
-    def process(self, m):
-        if self.accept:
-            if m.group('ins_open'):
-                return m.group('ins_text')
-            elif m.group('del_open'):
-                return ''
-            elif m.group('mark_open'):
-                return m.group('mark_text')
-            elif m.group('com_open'):
-                return ''
-            elif m.group('sub_open'):
-                return m.group('sub_ins_text')
-            else:
-                return m.group(0)
+RE_TAG_SRC_ATTR = re.compile(
+    r'''(?xus)
+    (?P<attr>
+        (?:
+            (?P<name>\s+src\s*=\s*)
+            (?P<path>"[^"]*"|'[^']*')
+        )
+    )
+    '''
+)
+
+RE_TAG_BAD_ATTR = re.compile(
+    r'''(?x)
+    (?P<attr>
+        (?:
+            \s+(?:id|class|style|on[\w]+)
+            (?:\s*=\s*(?:"[^"]*"|'[^']*'))
+        )*
+    )
+    ''',
+    re.DOTALL | re.UNICODE
+)
+
+RE_WIN_DRIVE = re.compile(r"(^[A-Za-z]{1}:(?:\\|/))")
+
+B64_FILE_TYPES = {
+    (".png",): "image/png",
+    (".jpg", ".jpeg"): "image/jpeg",
+    (".gif",): "image/gif"
+}
+
+B64_EXCLUDE = tuple(
+    ['https://', 'http://', '#'] +
+    ["data:%s;base64," % ft for ft in B64_FILE_TYPES.values()]
+)
+
+
+class HtmlRewriter(object):
+    '''
+    Rewrite the attributes of html tags in a single pass over the html.
+
+    Handlers are registered for a list of tag names (None for all tags)
+    and run in registration order; each gets the attribute string of a
+    tag and returns the new one.  Comments are kept unless strip_comments
+    is set.
+    '''
+    tag_patterns = {}
+
+    def __init__(self):
+        self.handlers = []
+        self.strip_comments = False
+
+    def register(self, tags, handler):
+        self.handlers.append((None if tags is None else frozenset(tags), handler))
+
+    def get_pattern(self):
+        ''' return the compiled tag pattern for the registered tag names '''
+        if any(tags is None for tags, handler in self.handlers):
+            names = r'[\w\:\.\-]+'
         else:
-            if m.group('ins_open'):
-                return ''
-            elif m.group('del_open'):
-                return m.group('del_text')
-            elif m.group('mark_open'):
-                return m.group('mark_text')
-            elif m.group('com_open'):
-                return ''
-            elif m.group('sub_open'):
-                return m.group('sub_del_text')
-            else:
-                return m.group(0)
+            names = '|'.join(sorted(set().union(*[tags for tags, handler in self.handlers])))
+        pattern = self.tag_patterns.get(names)
+        if pattern is None:
+            pattern = self.tag_patterns[names] = re.compile(RE_TAG_HTML % names)
+        return pattern
+
+    def repl(self, m):
+        if m.group('comments'):
+            return '' if self.strip_comments else m.group('comments')
+        tag = m.group('tag')
+        attr = m.group('attr')
+        for tags, handler in self.handlers:
+            if tags is None or tag in tags:
+                new_attr = handler(attr)
+                if new_attr != attr:
+                    attr = new_attr
+                    if RE_TAG_ATTRS.match(attr) is None:
+                        # The tag does not parse anymore, later rewrites
+                        # would not have found it either.
+                        break
+        return m.group('open') + attr + m.group('close')
+
+    def run(self, html):
+        if not self.handlers:
+            return html
+        return self.get_pattern().sub(self.repl, html)
+
+
+class CriticDump(object):
+    '''
+    Strip CriticMarkup from a source.
+
+    The source is scanned by jumping from one "{" to the next; the text in
+    between is copied as is.  A mark is closed by the first closing
+    delimiter that is followed by "}", like a lazy regular expression would.
+    '''
+
+    # opening delimiter: (closing delimiter, keep text on accept, keep text on reject)
+    MARKS = {
+        '++': ('++}', True, False),
+        '--': ('--}', False, True),
+        '==': ('==}', True, True),
+        '>>': ('<<}', False, False)
+    }
+
+    def match(self, source, start):
+        '''
+        Match a mark at the "{" at start.  Return the end of the mark and
+        its replacement, or None if there is no complete mark.
+        '''
+
+        opener = source[start + 1:start + 3]
+        if opener == '~~':
+            mid = source.find('~>', start + 3)
+            if mid == -1:
+                return None
+            end = source.find('~~}', mid + 2)
+            if end == -1:
+                return None
+            if self.accept:
+                return end + 3, source[mid + 2:end]
+            return end + 3, source[start + 3:mid]
+
+        mark = self.MARKS.get(opener)
+        if mark is None:
+            return None
+        end = source.find(mark[0], start + 3)
+        if end == -1:
+            return None
+        keep = mark[1] if self.accept else mark[2]
+        return end + 3, source[start + 3:end] if keep else ''
 
     def dump(self, source, accept):
-        text = ''
         self.accept = accept
-        for m in self.RE_CRITIC.finditer(source):
-            text += self.process(m)
-        return text
+        text = []
+        pos = 0
+        length = len(source)
+        while pos < length:
+            start = source.find('{', pos)
+            if start == -1:
+                break
+            m = self.match(source, start)
+            if m is None:
+                text.append(source[pos:start + 1])
+                pos = start + 1
+            else:
+                text.append(source[pos:start])
+                text.append(m[1])
+                pos = m[0]
+        text.append(source[pos:])
+        return ''.join(text)
+
+
+class LivePreview(object):
+    '''
+    Debounce and coalesce live preview renders.  Per view there is at most
+    one render in flight and one pending, and a render is skipped when the
+    buffer's change count did not move since the last one.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tokens = {}
+        self.in_flight = set()
+        self.pending = set()
+        self.rendered = {}
+
+    def modified(self, view, delay):
+        ''' Schedule a render once the view was left alone for delay ms. '''
+        view_id = view.id()
+        with self.lock:
+            token = self.tokens[view_id] = self.tokens.get(view_id, 0) + 1
+        sublime.set_timeout_async(lambda: self.fire(view, token), delay)
+
+    def fire(self, view, token):
+        view_id = view.id()
+        with self.lock:
+            if self.tokens.get(view_id) != token:
+                # More modifications came in, a later call will render
+                return
+            if view_id in self.in_flight:
+                self.pending.add(view_id)
+                return
+            self.in_flight.add(view_id)
+        sublime.set_timeout(lambda: self.start(view), 0)
+
+    def start(self, view):
+        ''' Run the preview command (UI thread). '''
+        view_id = view.id()
+        if not view.is_valid() or view.change_count() == self.rendered.get(view_id):
+            self.finished(view_id)
+            return
+        self.rendered[view_id] = view.change_count()
+        generation = PreviewJob.latest(view_id)
+        view.run_command('markdown_preview', {
+            'target': 'disk',
+            'parser': view.settings().get('parser')
+        })
+        if PreviewJob.latest(view_id) == generation:
+            # The command failed before it could queue a compile
+            self.finished(view_id)
+
+    def finished(self, view_id):
+        ''' Called when a preview of the view has been compiled. '''
+        with self.lock:
+            if view_id not in self.in_flight:
+                return
+            if view_id in self.pending:
+                self.pending.discard(view_id)
+            else:
+                self.in_flight.discard(view_id)
+                return
+        view = sublime.View(view_id)
+        sublime.set_timeout(lambda: self.start(view), 0)
+
+    def forget(self, view_id):
+        with self.lock:
+            for store in (self.tokens, self.rendered):
+                store.pop(view_id, None)
+            self.in_flight.discard(view_id)
+            self.pending.discard(view_id)
+
+
+live_preview = LivePreview()
 
 
 class MarkdownPreviewListener(sublime_plugin.EventListener):
     ''' auto update the output html if markdown file has already been converted once '''
 
+    def has_preview(self, view, settings):
+        ''' check if the view is a markdown file which has already been previewed '''
+        filetypes = settings.get('markdown_filetypes')
+        file_name = view.file_name()
+        return (
+            filetypes and file_name is not None and file_name.endswith(tuple(filetypes)) and
+            preview_files.has_file(view)
+        )
+
+    def on_modified_async(self, view):
+        settings = get_snapshot()
+        if settings.get('live_preview', False) and self.has_preview(view, settings):
+            live_preview.modified(view, settings.get('live_preview_delay', 500))
+
+    def on_close(self, view):
+        live_preview.forget(view.id())
+        preview_files.forget(view.id())
+
     def on_post_save(self, view):
-        settings = sublime.load_settings('MarkdownPreview.sublime-settings')
+        settings = get_snapshot()
         if settings.get('enable_autoreload', True):
-            filetypes = settings.get('markdown_filetypes')
-            file_name = view.file_name()
-            if filetypes and file_name is not None and file_name.endswith(tuple(filetypes)):
-                temp_file = getTempMarkdownPreviewPath(view)
-                if os.path.isfile(temp_file):
-                    # reexec markdown conversion
-                    # todo : check if browser still opened and reopen it if needed
-                    view.run_command('markdown_preview', {
-                        'target': 'disk',
-                        'parser': view.settings().get('parser')
-                    })
-                    sublime.status_message('Markdown preview file updated')
+            if self.has_preview(view, settings):
+                # reexec markdown conversion
+                # todo : check if browser still opened and reopen it if needed
+                view.run_command('markdown_preview', {
+                    'target': 'disk',
+                    'parser': view.settings().get('parser')
+                })
+                sublime.status_message('Markdown preview file updated')
 
 
 class MarkdownCheatsheetCommand(sublime_plugin.TextCommand):
@@ -392,6 +1256,7 @@ class MarkdownCheatsheetCommand(sublime_plugin.TextCommand):
 class Compiler(object):
     ''' Do the markdown converting '''
     default_css = "markdown.css"
+    highlight_downgraded = 0
 
     def isurl(self, css_name):
         match = re.match(r'https?://', css_name)
@@ -413,10 +1278,11 @@ class Compiler(object):
                 css_text.append(u"<link href='%s' rel='stylesheet' type='text/css'>" % css_name)
             elif os.path.isfile(os.path.expanduser(css_name)):
                 # use custom CSS file
-                css_text.append(u"<style>%s</style>" % load_utf8(os.path.expanduser(css_name)))
+                self.add_dependency(os.path.expanduser(css_name))
+                css_text.append(resource_cache.file(os.path.expanduser(css_name), u"<style>%s</style>"))
             elif css_name == 'default':
                 # use parser CSS file
-                css_text.append(u"<style>%s</style>" % load_resource(self.default_css))
+                css_text.append(resource_cache.resource(self.default_css, u"<style>%s</style>"))
 
         return u'\n'.join(css_text)
 
@@ -431,8 +1297,8 @@ class Compiler(object):
                 for filetype in filetypes:
                     if filename.endswith(filetype):
                         css_filename = filename.rpartition(filetype)[0] + '.css'
-                        if (os.path.isfile(css_filename)):
-                            return u"<style>%s</style>" % load_utf8(css_filename)
+                        if self.path_exists(css_filename) and os.path.isfile(css_filename):
+                            return resource_cache.file(css_filename, u"<style>%s</style>")
         return ''
 
     def get_stylesheet(self):
@@ -452,7 +1318,8 @@ class Compiler(object):
                 for js_file in js_files:
                     if os.path.isabs(js_file):
                         # Load the script inline to avoid cross-origin.
-                        scripts += u"<script>%s</script>" % load_utf8(js_file)
+                        self.add_dependency(js_file)
+                        scripts += resource_cache.file(js_file, u"<script>%s</script>")
                     else:
                         scripts += u"<script type='text/javascript' src='%s'></script>" % js_file
         return scripts
@@ -461,15 +1328,17 @@ class Compiler(object):
         ''' return the MathJax script if enabled '''
 
         if self.settings.get('enable_mathjax') is True:
-            return load_resource('mathjax.html')
+            return resource_cache.resource('mathjax.html')
         return ''
 
     def get_uml(self):
         ''' return the uml scripts if enabled '''
 
         if self.settings.get('enable_uml') is True:
-            flow = load_resource('flowchart-min.js')
-            return load_resource('uml.html').replace('{{ flowchart }}', flow, 1)
+            return resource_cache.get(
+                ('uml',), (resource_signature('uml.html'), resource_signature('flowchart-min.js')),
+                lambda: load_resource('uml.html').replace('{{ flowchart }}', load_resource('flowchart-min.js'), 1)
+            )
         return ''
 
     def get_highlight(self):
@@ -477,13 +1346,18 @@ class Compiler(object):
 
     def get_contents(self, wholefile=False):
         ''' Get contents or selection from view and optionally strip the YAML front matter '''
-        region = sublime.Region(0, self.view.size())
-        contents = self.view.substr(region)
+        contents = self.view.text
+        partial = False
         if not wholefile:
             # use selection if any
-            selection = self.view.substr(self.view.sel()[0])
+            selection = self.view.selection
             if selection.strip() != '':
                 contents = selection
+                partial = True
+
+        # Expand the source directives (toc/references, inline diagrams, code imports)
+        for expansion in self.get_expansions(partial):
+            contents = expansion.expand(contents)
 
         # Remove yaml front matter
         if self.settings.get('strip_yaml_front_matter') and contents.startswith('---'):
@@ -492,12 +1366,40 @@ class Compiler(object):
 
         references = self.settings.get('builtin').get('references', [])
         for ref in references:
+            self.add_dependency(ref)
             contents += get_references(ref)
 
         contents = self.parser_specific_preprocess(contents)
 
         return contents
 
+    def get_expansions(self, partial=False):
+        '''
+        Return the directive expansions to apply to the source, in order.
+        They need the location of the file, unsaved views are not expanded.
+        partial is set when only a selection of the document is expanded.
+        '''
+        file_name = self.view.file_name()
+        if file_name is None:
+            return []
+
+        expansions = []
+        if self.settings.get('chapter_compile'):
+            # A chapter of a sublime project is compiled by the project
+            project_dir = os.path.dirname(file_name)
+            self.add_dependency(project_dir)
+            if any(name.endswith('.sublime-project') for name in os.listdir(project_dir)):
+                print('Sublime project file found, skip chapter compile expansion!')
+            else:
+                expansions.append(TocRefs(file_name, self.add_dependency))
+        if self.settings.get('inline_diagram'):
+            expansions.append(InlineUmlDiagram(
+                file_name, self.view.variables, self.add_dependency, cleanup=not partial
+            ))
+        if self.settings.get('code_import'):
+            expansions.append(CodeImport(file_name, self.add_dependency))
+        return expansions
+
     def parser_specific_preprocess(self, text):
         return text
 
@@ -519,47 +1421,10 @@ class Compiler(object):
     def parser_specific_postprocess(self, text):
         return text
 
-    def postprocessor_pathconverter(self, html, image_convert, file_convert, absolute=False):
-
-        RE_TAG_HTML = r'''(?xus)
-        (?:
-            (?P<comments>(\r?\n?\s*)<!--[\s\S]*?-->(\s*)(?=\r?\n)|<!--[\s\S]*?-->)|
-            (?P<open><(?P<tag>(?:%s)))
-            (?P<attr>(?:\s+[\w\-:]+(?:\s*=\s*(?:"[^"]*"|'[^']*'))?)*)
-            (?P<close>\s*(?:\/?)>)
-        )
-        '''
+    def add_pathconverter(self, rewriter, image_convert, file_convert, absolute=False):
+        ''' register the conversion of href and src paths to absolute or relative paths '''
 
-        RE_TAG_LINK_ATTR = re.compile(
-            r'''(?xus)
-            (?P<attr>
-                (?:
-                    (?P<name>\s+(?:href|src)\s*=\s*)
-                    (?P<path>"[^"]*"|'[^']*')
-                )
-            )
-            '''
-        )
-
-        RE_SOURCES = re.compile(
-            RE_TAG_HTML % (
-                (r"img" if image_convert else "") +
-                (r"|" if image_convert and file_convert else "") +
-                (r"script|a|link" if file_convert else "")
-            )
-        )
-
-        def repl(m, base_path, rel_path=None):
-            if m.group('comments'):
-                tag = m.group('comments')
-            else:
-                tag = m.group('open')
-                if rel_path is None:
-                    tag += RE_TAG_LINK_ATTR.sub(lambda m2: repl_absolute(m2, base_path), m.group('attr'))
-                else:
-                    tag += RE_TAG_LINK_ATTR.sub(lambda m2: repl_relative(m2, base_path, rel_path), m.group('attr'))
-                tag += m.group('close')
-            return tag
+        tags = (['img'] if image_convert else []) + (['script', 'a', 'link'] if file_convert else [])
 
         basepath = self.settings.get('builtin').get("basepath")
         if basepath is None:
@@ -567,7 +1432,8 @@ class Compiler(object):
 
         if absolute:
             if basepath:
-                return RE_SOURCES.sub(lambda m: repl(m, basepath), html)
+                repl = self.memoize_links(lambda m: repl_absolute(m, basepath, self.path_exists))
+                rewriter.register(tags, lambda attr: RE_TAG_LINK_ATTR.sub(repl, attr))
         else:
             if self.preview:
                 relativepath = getTempMarkdownPreviewPath(self.view)
@@ -582,53 +1448,26 @@ class Compiler(object):
                 relativepath = os.path.dirname(relativepath)
 
             if basepath and relativepath:
-                return RE_SOURCES.sub(lambda m: repl(m, basepath, relativepath), html)
-        return html
-
-    def postprocessor_base64(self, html):
-        ''' convert resources (currently images only) to base64 '''
+                repl = self.memoize_links(lambda m: repl_relative(m, basepath, relativepath, self.path_exists))
+                rewriter.register(tags, lambda attr: RE_TAG_LINK_ATTR.sub(repl, attr))
 
-        file_types = {
-            (".png",): "image/png",
-            (".jpg", ".jpeg"): "image/jpeg",
-            (".gif",): "image/gif"
-        }
+    def add_base64(self, rewriter):
+        '''
+        register the conversion of resources (currently images only) to base64
 
-        exclusion_list = tuple(
-            ['https://', 'http://', '#'] +
-            ["data:%s;base64," % ft for ft in file_types.values()]
-        )
+        Images larger than image_base64_max_size (KB) are linked with an
+        absolute path instead of being embedded.
+        '''
 
-        RE_WIN_DRIVE = re.compile(r"(^[A-Za-z]{1}:(?:\\|/))")
-        RE_TAG_HTML = re.compile(
-            r'''(?xus)
-            (?:
-                (?P<comments>(\r?\n?\s*)<!--[\s\S]*?-->(\s*)(?=\r?\n)|<!--[\s\S]*?-->)|
-                (?P<open><(?P<tag>img))
-                (?P<attr>(?:\s+[\w\-:]+(?:\s*=\s*(?:"[^"]*"|'[^']*'))?)*)
-                (?P<close>\s*(?:\/?)>)
-            )
-            '''
-        )
-        RE_TAG_LINK_ATTR = re.compile(
-            r'''(?xus)
-            (?P<attr>
-                (?:
-                    (?P<name>\s+src\s*=\s*)
-                    (?P<path>"[^"]*"|'[^']*')
-                )
-            )
-            '''
-        )
+        base_path = self.settings.get('builtin').get("basepath")
+        if base_path is None:
+            base_path = ""
+        max_size = self.settings.get('image_base64_max_size', 0) * 1024
 
         def b64(m):
-            import base64
             data = m.group(0)
             try:
                 src = url2pathname(m.group('path')[1:-1])
-                base_path = self.settings.get('builtin').get("basepath")
-                if base_path is None:
-                    base_path = ""
 
                 # Format the link
                 absolute = False
@@ -641,75 +1480,37 @@ class Compiler(object):
                     absolute = True
 
                 # Make sure we are working with an absolute path
-                if not src.startswith(exclusion_list):
+                if not src.startswith(B64_EXCLUDE):
                     if absolute:
                         src = os.path.normpath(src)
                     else:
                         src = os.path.normpath(os.path.join(base_path, src))
 
-                    if os.path.exists(src):
+                    if self.path_exists(src):
+                        signature = self.dependencies[src]
                         ext = os.path.splitext(src)[1].lower()
-                        for b64_ext in file_types:
+                        for b64_ext in B64_FILE_TYPES:
                             if ext in b64_ext:
-                                with open(src, "rb") as f:
-                                    data = " src=\"data:%s;base64,%s\"" % (
-                                        file_types[b64_ext],
-                                        base64.b64encode(f.read()).decode('ascii')
+                                if max_size and signature[1] > max_size:
+                                    data = repl_absolute(m, base_path, self.path_exists)
+                                else:
+                                    data = " src=\"%s\"" % base64_cache.get(
+                                        src, signature, B64_FILE_TYPES[b64_ext]
                                     )
                                 break
             except Exception:
                 pass
             return data
 
-        def repl(m):
-            if m.group('comments'):
-                tag = m.group('comments')
-            else:
-                tag = m.group('open')
-                tag += RE_TAG_LINK_ATTR.sub(lambda m2: b64(m2), m.group('attr'))
-                tag += m.group('close')
-            return tag
-
-        return RE_TAG_HTML.sub(repl, html)
+        repl = self.memoize_links(b64)
+        rewriter.register(['img'], lambda attr: RE_TAG_SRC_ATTR.sub(repl, attr))
 
-    def postprocessor_simple(self, html):
-        ''' Strip out ids and classes for a simplified HTML output '''
-
-        def repl(m):
-            if m.group('comments'):
-                tag = ''
-            else:
-                tag = m.group('open')
-                tag += RE_TAG_BAD_ATTR.sub('', m.group('attr'))
-                tag += m.group('close')
-            return tag
+    def add_simple(self, rewriter):
+        ''' register the removal of comments, ids and classes for a simplified HTML output '''
 
         # Strip out id, class, on<word>, and style attributes for a simple html output
-        RE_TAG_HTML = re.compile(
-            r'''(?x)
-            (?:
-                (?P<comments>(\r?\n?\s*)<!--[\s\S]*?-->(\s*)(?=\r?\n)|<!--[\s\S]*?-->)|
-                (?P<open><[\w\:\.\-]+)
-                (?P<attr>(?:\s+[\w\-:]+(?:\s*=\s*(?:"[^"]*"|'[^']*'))?)*)
-                (?P<close>\s*(?:\/?)>)
-            )
-            ''',
-            re.DOTALL | re.UNICODE
-        )
-
-        RE_TAG_BAD_ATTR = re.compile(
-            r'''(?x)
-            (?P<attr>
-                (?:
-                    \s+(?:id|class|style|on[\w]+)
-                    (?:\s*=\s*(?:"[^"]*"|'[^']*'))
-                )*
-            )
-            ''',
-            re.DOTALL | re.UNICODE
-        )
-
-        return RE_TAG_HTML.sub(repl, html)
+        rewriter.strip_comments = True
+        rewriter.register(None, lambda attr: RE_TAG_BAD_ATTR.sub('', attr))
 
     def convert_markdown(self, markdown_text):
         ''' convert input markdown to HTML, with github or builtin parser '''
@@ -721,19 +1522,22 @@ class Compiler(object):
 
         markdown_html = self.parser_specific_postprocess(markdown_html)
 
+        # All tag rewrites are done in one pass over the html, in this order.
+        rewriter = HtmlRewriter()
+
         if "absolute" in (image_convert, file_convert):
-            markdown_html = self.postprocessor_pathconverter(markdown_html, image_convert, file_convert, True)
+            self.add_pathconverter(rewriter, image_convert, file_convert, True)
 
         if "relative" in (image_convert, file_convert):
-            markdown_html = self.postprocessor_pathconverter(markdown_html, image_convert, file_convert, False)
+            self.add_pathconverter(rewriter, image_convert, file_convert, False)
 
         if image_convert == "base64":
-            markdown_html = self.postprocessor_base64(markdown_html)
+            self.add_base64(rewriter)
 
         if self.settings.get("html_simple", False):
-            markdown_html = self.postprocessor_simple(markdown_html)
+            self.add_simple(rewriter)
 
-        return markdown_html
+        return rewriter.run(markdown_html)
 
     def get_title(self):
         if self.meta_title is not None:
@@ -765,22 +1569,96 @@ class Compiler(object):
                 )
         return '\n'.join(meta)
 
-    def run(self, view, wholefile=False, preview=False):
-        ''' return full html and body html for view. '''
-        self.settings = Settings('MarkdownPreview.sublime-settings', view.file_name())
+    def check_cancelled(self):
+        ''' Stop compiling if the preview request has been superseded. '''
+        if self.cancelled is not None and self.cancelled():
+            raise CompileCancelled()
+
+    def add_dependency(self, path):
+        ''' Record a file the output depends on, return its signature. '''
+        signature = file_signature(path)
+        self.dependencies[path] = signature
+        return signature
+
+    def path_exists(self, path):
+        '''
+        os.path.exists that records the path as a dependency.  Each path is
+        only stat'ed once per render.
+        '''
+        if path in self.dependencies:
+            return self.dependencies[path] is not None
+        return self.add_dependency(path) is not None
+
+    def memoize_links(self, repl):
+        '''
+        Wrap a link replacement function with a per render cache keyed by
+        the raw attribute, so every unique link is resolved only once.
+        '''
+        links = {}
+
+        def memoized(m):
+            key = m.group(0)
+            link = links.get(key)
+            if link is None:
+                link = links[key] = repl(m)
+            return link
+        return memoized
+
+    def get_render_key(self, wholefile):
+        ''' Return the render cache key for the current view and settings. '''
+        text = self.view.text
+        if not wholefile and self.view.selection.strip() != '':
+            text = self.view.selection
+        key = json.dumps(
+            [
+                self.__class__.__name__, getattr(self, 'parser', None), self.preview,
+                self.view.file_name(), self.view.name(), self.view.id() if self.preview else None,
+                self.view.variables, [self.settings.get(name) for name in RENDER_SETTINGS]
+            ],
+            sort_keys=True, default=str
+        )
+        return hashlib.sha1((key + '\n' + text).encode('utf-8')).hexdigest()
+
+    def run(self, view, wholefile=False, preview=False, settings=None, cancelled=None):
+        '''
+        return full html and body html for view.
+
+        view can be a ViewSnapshot, in which case run is safe to call from a
+        worker thread.  cancelled is an optional callable; CompileCancelled
+        is raised between the compile stages once it returns True.
+        Compiled documents are kept in the render cache.
+        '''
+        if not isinstance(view, ViewSnapshot):
+            view = ViewSnapshot(view)
+        if settings is None:
+            settings = Settings('MarkdownPreview.sublime-settings', view.file_name())
+        self.settings = settings
         self.preview = preview
         self.view = view
+        self.cancelled = cancelled
+        self.dependencies = {}
+
+        render_cache.resize(int(self.settings.get('render_cache_size', 32) * 1024 * 1024))
+        key = self.get_render_key(wholefile)
+        cached = render_cache.get(key)
+        if cached is not None:
+            html, body, overrides, self.highlight_downgraded, dependencies = cached
+            self.settings.set_overrides(overrides)
+            self.dependencies = dict(dependencies)
+            return html, body
 
         contents = self.get_contents(wholefile)
+        self.check_cancelled()
 
         body = self.convert_markdown(contents)
+        self.check_cancelled()
 
         html_template = self.settings.get('html_template')
 
         # use customized html template if given
         if self.settings.get('html_simple', False):
             html = body
-        elif html_template and os.path.exists(html_template):
+        elif html_template and self.path_exists(html_template):
             head = u''
             head += self.get_meta()
             if not self.settings.get('skip_default_stylesheet'):
@@ -791,7 +1669,7 @@ class Compiler(object):
             head += self.get_uml()
             head += self.get_title()
 
-            html = load_utf8(html_template)
+            html = resource_cache.file(html_template)
             html = html.replace('{{ HEAD }}', head, 1)
             html = html.replace('{{ BODY }}', body, 1)
         else:
@@ -811,13 +1689,76 @@ class Compiler(object):
             html += '</body>'
             html += '</html>'
 
+        if body != _CANNOT_CONVERT:
+            render_cache.set(
+                key, (
+                    html, body, self.settings.get_overrides(), self.highlight_downgraded,
+                    dict(self.dependencies)
+                ),
+                self.dependencies, len(html) + len(body)
+            )
         return html, body
 
 
 class GithubCompiler(Compiler):
     default_css = "github.css"
 
-    def curl_convert(self, data):
+    RE_FENCE = re.compile(r'^[ ]{0,3}(`{3,}|~{3,})')
+    RE_FENCE_CLOSE = re.compile(r'^[ ]{0,3}(?:`{3,}|~{3,})[ \t]*\r?$')
+    RE_TOP_HEADER = re.compile(r'^[ ]{0,3}#(?:[ \t]|\r?\n|$)')
+    RE_REFERENCE = re.compile(r'^[ ]{0,3}\[(?!\^)[^\]]+\]:[ \t]*\S')
+    RE_FOOTNOTE = re.compile(r'^[ ]{0,3}\[\^[^\]]+\]:', re.MULTILINE)
+
+    def split_chunks(self, markdown_text, chunk_size):
+        '''
+        Split the text at top level headers outside of fenced code into
+        chunks of at least chunk_size characters.  Reference definitions
+        are copied into every chunk so links resolve in all of them.
+        '''
+        chunks = []
+        references = []
+        chunk = []
+        length = 0
+        fence = None
+        for line in markdown_text.splitlines(True):
+            m = self.RE_FENCE.match(line)
+            if fence is not None:
+                # A closing fence has nothing but spaces after the fence characters
+                if (
+                    m is not None and m.group(1)[0] == fence[0] and len(m.group(1)) >= len(fence) and
+                    self.RE_FENCE_CLOSE.match(line) is not None
+                ):
+                    fence = None
+            elif m is not None:
+                fence = m.group(1)
+            elif self.RE_TOP_HEADER.match(line) is not None and length >= chunk_size:
+                chunks.append(chunk)
+                chunk = []
+                length = 0
+            elif self.RE_REFERENCE.match(line) is not None:
+                references.append(line.rstrip('\r\n'))
+            chunk.append(line)
+            length += len(line)
+        chunks.append(chunk)
+
+        if len(chunks) > 1 and references:
+            references = u'\n\n' + u'\n'.join(references) + u'\n'
+            return [u''.join(chunk) + references for chunk in chunks]
+        return [u''.join(chunk) for chunk in chunks]
+
+    def convert_chunks(self, url, chunks, mode, token, max_age):
+        '''
+        Convert the chunks with at most github_max_requests requests in
+        flight, and join the results in order.  The requests are sent by
+        the threads of github_pool, which keep their connections open.
+        '''
+        count = max(1, min(self.settings.get('github_max_requests', 4), len(chunks)))
+        results = github_pool.map(
+            lambda chunk: github_client.convert(url, chunk, mode, token, max_age), chunks, count
+        )
+        return u'\n'.join(results)
+
+    def curl_convert(self, data, url=GITHUB_API_URL):
         try:
             import subprocess
 
@@ -831,7 +1772,7 @@ class GithubCompiler(Compiler):
                 'Content-Type: application/json',
                 '-d',
                 shell_safe_json,
-                'https://api.github.com/markdown'
+                url
             ]
 
             github_oauth_token = self.settings.get('github_oauth_token')
@@ -905,6 +1846,7 @@ class GithubCompiler(Compiler):
         # use the github API
         sublime.status_message('converting markdown with github API...')
         github_mode = self.settings.get('github_mode', 'gfm')
+        url = self.settings.get('github_api_url', GITHUB_API_URL)
         data = {
             "text": markdown_text,
             "mode": github_mode
@@ -916,15 +1858,24 @@ class GithubCompiler(Compiler):
             return 'GitHub\'s original response: (HTTP Status Code %s) "%s"' % (e.code, body['message'])
 
         try:
-            headers = {
-                'Content-Type': 'application/json'
-            }
-            if github_oauth_token:
-                headers['Authorization'] = "token %s" % github_oauth_token
-            url = "https://api.github.com/markdown"
             sublime.status_message(url)
-            request = Request(url, data, headers)
-            markdown_html = urlopen(request).read().decode('utf-8')
+            chunk_size = self.settings.get('github_chunk_size', 0) * 1024
+            max_age = self.settings.get('github_cache_max_age', 3600)
+            # GitHub numbers duplicate header anchors (gfm mode) and footnotes
+            # per request, and a footnote only resolves with its definition in
+            # the same request; such documents are sent whole
+            if (
+                chunk_size and github_mode != 'gfm' and len(markdown_text) > chunk_size and
+                self.RE_FOOTNOTE.search(markdown_text) is None
+            ):
+                markdown_html = self.convert_chunks(
+                    url, self.split_chunks(markdown_text, chunk_size),
+                    github_mode, github_oauth_token, max_age
+                )
+            else:
+                markdown_html = github_client.convert(
+                    url, markdown_text, github_mode, github_oauth_token, max_age
+                )
         except HTTPError as e:
             if e.code == 401:
                 error_message = 'GitHub API authentication failed. Please check your OAuth token.\n\n'
@@ -943,7 +1894,7 @@ class GithubCompiler(Compiler):
         except URLError:
             # Maybe this is a Linux-install of ST which doesn't bundle with SSL support
             # So let's try wrapping curl instead
-            markdown_html = self.curl_convert(data)
+            markdown_html = self.curl_convert(data, url)
         except:
             e = sys.exc_info()[1]
             print(e)
@@ -957,6 +1908,10 @@ class GithubCompiler(Compiler):
 
 class ExternalMarkdownCompiler(Compiler):
     default_css = "markdown.css"
+    # Converted documents and worker processes, shared by all compilers
+    output_cache = {}
+    workers = {}
+    workers_lock = threading.Lock()
 
     def __init__(self, parser):
         """Initialize."""
@@ -964,59 +1919,166 @@ class ExternalMarkdownCompiler(Compiler):
         self.parser = parser
         super(ExternalMarkdownCompiler, self).__init__()
 
-    def parser_specific_convert(self, markdown_text):
+    def spawn(self, cmd, stderr):
         import subprocess
-        settings = sublime.load_settings("MarkdownPreview.sublime-settings")
-        binary = settings.get('markdown_binary_map', {})[self.parser]
+        if sublime.platform() == "windows":
+            startupinfo = subprocess.STARTUPINFO()
+            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+            return subprocess.Popen(
+                cmd, startupinfo=startupinfo,
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr
+            )
+        return subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr
+        )
+
+    def convert_once(self, cmd, data):
+        ''' run the binary for one document, return the return code and output '''
+        import subprocess
+        p = self.spawn(cmd, subprocess.PIPE)
+        output = p.communicate(data)[0]
+        return p.returncode, output
+
+    @staticmethod
+    def read_frame(stream):
+        ''' read a length framed payload from stream '''
+        length = int(stream.readline())
+        payload = stream.read(length)
+        if len(payload) != length:
+            raise IOError('incomplete response')
+        return payload
+
+    def convert_worker(self, cmd, data, timeout=30):
+        '''
+        Convert with a long-lived worker process, started on first use.
+        Requests and responses are framed the same way: the length of the
+        payload in bytes on a line of its own, followed by the payload.
+        A worker that fails, or does not respond within timeout seconds, is
+        killed and the document is converted by a process of its own; a new
+        worker is started on the next request.
+        '''
+        key = tuple(cmd)
+        request = ('%d\n' % len(data)).encode('ascii') + data
+        with self.workers_lock:
+            worker = self.workers.get(key)
+            if worker is None or worker[0].poll() is not None:
+                worker = self.workers[key] = (self.spawn(cmd, None), threading.Lock())
+        process, lock = worker
+        response = []
+        abandoned = threading.Event()
+
+        def exchange():
+            try:
+                process.stdin.write(request)
+                process.stdin.flush()
+                response.append(self.read_frame(process.stdout))
+            except (IOError, OSError, ValueError):
+                if not abandoned.is_set():
+                    print(traceback.format_exc())
+
+        with lock:
+            # The pipes are served by a thread, so a hung worker can be abandoned
+            thread = threading.Thread(target=exchange)
+            thread.daemon = True
+            thread.start()
+            thread.join(timeout)
+            if response:
+                return 0, response[0]
+            if thread.is_alive():
+                abandoned.set()
+                print('%s did not respond within %d seconds' % (cmd[0], timeout))
+            try:
+                process.kill()
+            except OSError:
+                pass
+            with self.workers_lock:
+                if self.workers.get(key) is worker:
+                    del self.workers[key]
+
+        returncode, output = self.convert_once(cmd, request)
+        if not returncode:
+            try:
+                output = self.read_frame(io.BytesIO(output))
+            except (IOError, ValueError):
+                returncode = 1
+        return returncode, output
 
-        if len(binary) and os.path.exists(binary[0]):
+    @classmethod
+    def stop_workers(cls):
+        ''' terminate the worker processes '''
+        with cls.workers_lock:
+            workers = list(cls.workers.values())
+            cls.workers.clear()
+        for process, lock in workers:
+            try:
+                process.stdin.close()
+                process.terminate()
+            except (IOError, OSError):
+                pass
+
+    def parser_specific_convert(self, markdown_text):
+        binary = self.settings.get('markdown_binary_map', {})[self.parser]
+
+        if len(binary) and self.path_exists(binary[0]):
             cmd = binary
+            data = (markdown_text + '\n').encode('utf-8')
+            key = hashlib.sha1(
+                json.dumps([cmd, self.dependencies[binary[0]]]).encode('utf-8') + b'\n' + data
+            ).hexdigest()
+            markdown_html = self.output_cache.get(key)
+            if markdown_html is not None:
+                return markdown_html
+
             sublime.status_message('converting markdown with %s...' % self.parser)
-            if sublime.platform() == "windows":
-                startupinfo = subprocess.STARTUPINFO()
-                startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-                p = subprocess.Popen(
-                    cmd, startupinfo=startupinfo,
-                    stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+            if self.parser in self.settings.get('markdown_binary_workers', []):
+                returncode, output = self.convert_worker(
+                    cmd, data, self.settings.get('markdown_binary_timeout', 30)
                 )
             else:
-                p = subprocess.Popen(
-                    cmd,
-                    stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-                )
-            for line in markdown_text.split('\n'):
-                p.stdin.write((line + '\n').encode('utf-8'))
-            markdown_html = p.communicate()[0].decode("utf-8")
-            if p.returncode:
+                returncode, output = self.convert_once(cmd, data)
+            markdown_html = output.decode("utf-8")
+            if returncode:
                 # Log info to console
                 sublime.error_message("Could not convert file! See console for more info.")
                 print(markdown_html)
                 markdown_html = _CANNOT_CONVERT
+            else:
+                if len(self.output_cache) >= 64:
+                    self.output_cache.clear()
+                self.output_cache[key] = markdown_html
         else:
-            sublime.error_message("Cannot find % binary!" % self.binary)
+            sublime.error_message("Cannot find %s binary!" % self.parser)
             markdown_html = _CANNOT_CONVERT
         return markdown_html
 
 
 class MarkdownCompiler(Compiler):
     default_css = "markdown.css"
+    # Resolved extension lists and Pygments stylesheets, see get_config_extensions
+    extension_cache = {}
+    highlight_cache = {}
 
     def set_highlight(self, pygments_style, css_class):
         ''' Set the Pygments css. '''
 
         if pygments_style and not self.noclasses:
-            style = None
-            if pygments_style not in pygments_local:
-                try:
-                    style = get_formatter_by_name('html', style=pygments_style).get_style_defs('.codehilite pre')
-                except Exception:
-                    pygments_style = 'github'
-            if style is None:
-                style = load_resource(pygments_local[pygments_style]) % {
-                    'css_class': ''.join(['.' + x for x in css_class.split(' ') if x])
-                }
+            key = (pygments_style, css_class)
+            cached = self.highlight_cache.get(key)
+            if cached is None:
+                style = None
+                if pygments_style not in pygments_local:
+                    try:
+                        style = get_formatter_by_name('html', style=pygments_style).get_style_defs('.codehilite pre')
+                    except Exception:
+                        pygments_style = 'github'
+                if style is None:
+                    style = resource_cache.resource(pygments_local[pygments_style]) % {
+                        'css_class': ''.join(['.' + x for x in css_class.split(' ') if x])
+                    }
+                cached = self.highlight_cache[key] = (pygments_style, '<style>%s</style>' % style)
 
-            self.pygments_style = '<style>%s</style>' % style
+            pygments_style, self.pygments_style = cached
         return pygments_style
 
     def get_highlight(self):
@@ -1032,11 +2094,18 @@ class MarkdownCompiler(Compiler):
             text = self.preprocessor_critic(text)
         return text
 
+    @staticmethod
+    def is_codehilite(extension):
+        ''' check if an extension string, like "markdown.extensions.codehilite(...)", is codehilite '''
+        return extension.split('(', 1)[0].strip().rpartition('.')[2] == 'codehilite'
+
     def process_extensions(self, extensions):
         re_pygments = re.compile(r"(?:\s*,)?pygments_style\s*=\s*([a-zA-Z][a-zA-Z_\d]*)")
         re_pygments_replace = re.compile(r"pygments_style\s*=\s*([a-zA-Z][a-zA-Z_\d]*)")
         re_use_pygments = re.compile(r"use_pygments\s*=\s*(True|False)")
-        re_insert_pygment = re.compile(r"(?P<bracket_start>codehilite\([^)]+?)(?P<bracket_end>\s*\)$)|(?P<start>codehilite)")
+        re_insert_pygment = re.compile(
+            r"(?P<bracket_start>(?:[\w.]+\.)?codehilite\([^)]+?)(?P<bracket_end>\s*\)$)|(?P<start>(?:[\w.]+\.)?codehilite)"
+        )
         re_no_classes = re.compile(r"(?:\s*,)?noclasses\s*=\s*(True|False)")
         re_css_class = re.compile(r"css_class\s*=\s*([\w\-]+)")
         # First search if pygments has manually been set,
@@ -1048,7 +2117,7 @@ class MarkdownCompiler(Compiler):
 
         count = 0
         for e in extensions:
-            if e.startswith("codehilite"):
+            if self.is_codehilite(e):
                 m = re_use_pygments.search(e)
                 use_pygments = True if m is None else m.group(1) == 'True'
                 m = re_css_class.search(e)
@@ -1102,6 +2171,69 @@ class MarkdownCompiler(Compiler):
         if not use_pygments:
             self.pygments_style = None
 
+        # Apply the highlight size budget unless it was set manually.
+        budget = (
+            ('max_lines', self.settings.get('highlight_max_lines', 0)),
+            ('max_bytes', self.settings.get('highlight_max_bytes', 0)),
+            ('max_total_bytes', self.settings.get('highlight_max_document_bytes', 0))
+        )
+        for count, e in enumerate(extensions):
+            if self.is_codehilite(e):
+                options = ','.join(
+                    ['%s=%d' % (k, v) for k, v in budget if v and re.search(r'\b%s\s*=' % k, e) is None]
+                )
+                if options and e.endswith(')'):
+                    start = e[:-1].rstrip()
+                    extensions[count] = start + ('' if start.endswith('(') else ',') + options + ')'
+                elif options:
+                    extensions[count] = e + '(%s)' % options
+
+        return extensions
+
+    def report_highlight_budget(self, md):
+        ''' Report code blocks that were too large to be highlighted with Pygments. '''
+        self.highlight_downgraded = 0
+        for ext in md.registeredExtensions:
+            if isinstance(ext, codehilite.CodeHiliteExtension):
+                self.highlight_downgraded = ext.budget.downgraded
+        if self.highlight_downgraded:
+            message = '%d code block(s) exceeded the highlight budget and were not highlighted with Pygments' % (
+                self.highlight_downgraded
+            )
+            print(message)
+            sublime.status_message(message)
+
+    def get_config_extensions(self, default_extensions):
+        '''
+        Return the extensions to use.  The result of process_extensions only
+        depends on the settings in the key, so it is computed once per key.
+        '''
+        config_extensions = self.settings.get('enabled_extensions')
+        key = json.dumps(
+            [default_extensions, config_extensions] + [
+                self.settings.get(name) for name in (
+                    'enable_highlight', 'enable_pygments', 'guess_language',
+                    'highlight_max_lines', 'highlight_max_bytes', 'highlight_max_document_bytes'
+                )
+            ],
+            default=str
+        )
+        cached = self.extension_cache.get(key)
+        if cached is None:
+            if not config_extensions or config_extensions == 'default':
+                config_extensions = list(default_extensions)
+            else:
+                # The list is shared with the settings snapshot
+                config_extensions = list(config_extensions)
+                if 'default' in config_extensions:
+                    config_extensions.remove('default')
+                    config_extensions.extend(default_extensions)
+            extensions = self.process_extensions(config_extensions)
+            if len(self.extension_cache) >= 64:
+                self.extension_cache.clear()
+            cached = self.extension_cache[key] = (extensions, self.pygments_style, self.noclasses)
+        extensions, self.pygments_style, self.noclasses = cached
+
         # Get the base path of source file if available
         base_path = self.settings.get('builtin').get("basepath")
         if base_path is None:
@@ -1110,20 +2242,12 @@ class MarkdownCompiler(Compiler):
         # Replace BASE_PATH keyword with the actual base_path
         return [e.replace("${BASE_PATH}", base_path) for e in extensions]
 
-    def get_config_extensions(self, default_extensions):
-        config_extensions = self.settings.get('enabled_extensions')
-        if not config_extensions or config_extensions == 'default':
-            return self.process_extensions(default_extensions)
-        if 'default' in config_extensions:
-            config_extensions.remove('default')
-            config_extensions.extend(default_extensions)
-        return self.process_extensions(config_extensions)
-
     def parser_specific_convert(self, markdown_text):
         sublime.status_message('converting markdown with Python markdown...')
         config_extensions = self.get_config_extensions(DEFAULT_EXT)
         md = Markdown(extensions=config_extensions)
         html_text = md.convert(markdown_text)
+        self.report_highlight_budget(md)
         # Retrieve the meta data returned from the "meta" extension
         self.settings.add_meta(md.Meta)
         return html_text
@@ -1132,7 +2256,7 @@ class MarkdownCompiler(Compiler):
 class MarkdownPreviewSelectCommand(sublime_plugin.TextCommand):
     def run(self, edit, target='browser'):
 
-        settings = sublime.load_settings("MarkdownPreview.sublime-settings")
+        settings = get_snapshot()
         md_map = settings.get('markdown_binary_map', {})
         parsers = [
             "markdown",
@@ -1182,7 +2306,7 @@ class MarkdownPreviewCommand(sublime_plugin.TextCommand):
     def run(self, edit, parser='markdown', target='browser'):
 
 
-        settings = sublime.load_settings('MarkdownPreview.sublime-settings')
+        settings = get_snapshot()
 
         # backup parser+target for later saves
         self.view.settings().set('parser', parser)
@@ -1198,40 +2322,6 @@ class MarkdownPreviewCommand(sublime_plugin.TextCommand):
             # Fallback to Python Markdown
             compiler = MarkdownCompiler()
 
-        # #################################################################
-        # ######################################## @@@ MDB (07-02-2017) ###
-        # #################################################################
-
-        # If a *.sublime-project file exists within base directory of calling markdown file,
-        # skip chapter compile modifications!
-        DO_CHAPTER_COMPILE = 0
-
-        if self.view.file_name() != None:
-            DO_CHAPTER_COMPILE = settings.get("chapter_compile")
-            if DO_CHAPTER_COMPILE:
-                for file in os.listdir(os.path.dirname(self.view.file_name())):
-                    if file.endswith(".sublime-project"):
-                        print("Sublime project file", file, "found, skip chapter compile modifications!")
-                        osd.info("Sublime project file %s ".format(file) + "found, skip chapter compile modifications!").send()
-                        DO_CHAPTER_COMPILE = 0
-                        break
-            if DO_CHAPTER_COMPILE:
-                self.temp_toc_refs(edit, 'insert')
-
-        # Check if PlantUML inline diagram rendering is enabled in user settings.
-        if settings.get("inline_diagram"):
-            procInline = False
-            inlineUml = InlineUmlDiagram(self.view)
-
-            # Process inline replacements
-            procInline = inlineUml.process(self.view, edit)
-
-        # Check if external code import feature is enabled in user settings.
-        if settings.get("code_import"):
-            dprint('code importer')
-            codeImport = CodeImport(self.view, edit)
-            codeImport.process(self.view, edit)
-
         # Check if validate-title feature is enabled in user settings.
         if settings.get("validate_title"):
             _title=validate_title(self.view)
@@ -1242,28 +2332,77 @@ class MarkdownPreviewCommand(sublime_plugin.TextCommand):
                 osd.crit('Validate Title', 'No title meta data found!')
 
         # #################################################################
-        # Invoke markdown compiler
-        # #################################################################
-        html, body = compiler.run(self.view, preview=(target in ['disk', 'browser']))
+        # Snapshot the buffer, the compile itself runs on a worker thread.
+        # Directives are expanded on the snapshot's text by the compiler.
         # #################################################################
+        snapshot = ViewSnapshot(self.view)
+        compiler_settings = Settings('MarkdownPreview.sublime-settings', snapshot.file_name(), settings)
+
+        # A newer preview of this view supersedes any one still in flight.
+        job = PreviewJob(self.view.id())
+        window = self.view.window()
+        run_async(
+            lambda: self.compile(job, compiler, snapshot, compiler_settings, settings, window, target)
+        )
+
+    def compile(self, *args):
+        ''' Compile on a worker thread, and let live preview know when done. '''
+        try:
+            self.compile_job(*args)
+        finally:
+            live_preview.finished(args[0].view_id)
+
+    def compile_job(self, job, compiler, snapshot, compiler_settings, settings, window, target):
+        ''' Compile the snapshot on a worker thread and hand the result to the UI thread. '''
+        if job.cancelled():
+            return
+        try:
+            # #################################################################
+            # Invoke markdown compiler
+            # #################################################################
+            html, body = compiler.run(
+                snapshot, preview=(target in ['disk', 'browser']),
+                settings=compiler_settings, cancelled=job.cancelled
+            )
+            # #################################################################
+
+            html = self.postprocess_html(html, settings)
+
+            if target in ['disk', 'browser']:
+                # do not use LiveReload unless autoreload is enabled
+                if settings.get('enable_autoreload', True):
+                    # check if LiveReload ST2 extension installed and add its script to the resulting HTML
+                    livereload_installed = ('LiveReload' in os.listdir(sublime.packages_path()))
+                    # build the html
+                    if livereload_installed:
+                        port = get_snapshot('LiveReload.sublime-settings').get('port', 35729)
+                        html += '<script>document.write(\'<script src="http://\' + (location.host || \'localhost\').split(\':\')[0] + \':%d/livereload.js?snipver=1"></\' + \'script>\')</script>' % port
+                if job.cancelled():
+                    return
+                # update output html file
+                preview_files.write(
+                    getTempMarkdownPreviewPath(snapshot), html, snapshot.id(), snapshot.change_count()
+                )
+        except CompileCancelled:
+            return
+        except Exception:
+            traceback.print_exc()
+            sublime.set_timeout(lambda: sublime.status_message('Markdown preview failed, see console'), 0)
+            return
+
+        sublime.set_timeout(
+            lambda: self.deliver(job, compiler, snapshot, settings, window, target, html, body), 0
+        )
 
+    def postprocess_html(self, html, settings):
+        ''' Apply the optional html modifications to the compiled document. '''
         if settings.get("paragraph_numbering") == None:
-            print("%s on %s returns: None" 
+            print("%s on %s returns: None"
                 % (os.path.basename(__file__), 'settings.get("paragraph_numbering")'))
         else:
             if settings.get("paragraph_numbering"):
                 html = self.addParagraphNumbering(html)
 
-        # Check if external code import feature is enabled in user settings.
-        if settings.get("code_import"):
-            if codeImport:
-                codeImport.unprocess()
-
-        # Check if PlantUML inline diagram rendering is enabled in user settings.
-        if settings.get("inline_diagram"):
-            if procInline:
-                inlineUml.unprocess()
-
         # Check if article footer attribute exists in user settings
         if settings.has("make_article_footer") & settings.has("article_footer"):
             if settings.get("make_article_footer"):
@@ -1284,36 +2423,23 @@ class MarkdownPreviewCommand(sublime_plugin.TextCommand):
             keySeqs = settings.get("disable_href_in_toc")["key_sequences"]
             start, stop, tocStr = self.getModifiedTocBlock(html, keySeqs)
             html = html[0:start-1] + tocStr + html[stop-1:-1]
+        return html
 
-        if DO_CHAPTER_COMPILE:
-            self.temp_toc_refs(edit, 'clear')
-
-        # #################################################################
-        # #################################################################
-        # #################################################################
-        #
-        if target in ['disk', 'browser']:
-            # do not use LiveReload unless autoreload is enabled
-            if settings.get('enable_autoreload', True):
-                # check if LiveReload ST2 extension installed and add its script to the resulting HTML
-                livereload_installed = ('LiveReload' in os.listdir(sublime.packages_path()))
-                # build the html
-                if livereload_installed:
-                    port = sublime.load_settings('LiveReload.sublime-settings').get('port', 35729)
-                    html += '<script>document.write(\'<script src="http://\' + (location.host || \'localhost\').split(\':\')[0] + \':%d/livereload.js?snipver=1"></\' + \'script>\')</script>' % port
-            # update output html file
-            tmp_fullpath = getTempMarkdownPreviewPath(self.view)
-            save_utf8(tmp_fullpath, html)
-            # now opens in browser if needed
-            if target == 'browser':
-                self.__class__.open_in_browser(tmp_fullpath, settings.get('browser', 'default'))
+    def deliver(self, job, compiler, snapshot, settings, window, target, html, body):
+        ''' Show the compiled preview (UI thread). '''
+        if job.cancelled():
+            return
+
+        if target == 'browser':
+            # now opens in browser
+            self.__class__.open_in_browser(getTempMarkdownPreviewPath(snapshot), settings.get('browser', 'default'))
         elif target == 'sublime':
             # create a new buffer and paste the output HTML
             embed_css = settings.get('embed_css_for_sublime_output', True)
             if embed_css:
-                new_view(self.view.window(), html, scratch=True)
+                new_view(window, html, scratch=True)
             else:
-                new_view(self.view.window(), body, scratch=True)
+                new_view(window, body, scratch=True)
             sublime.status_message('Markdown preview launched in sublime')
         elif target == 'clipboard':
             # clipboard copy the full HTML
@@ -1322,10 +2448,10 @@ class MarkdownPreviewCommand(sublime_plugin.TextCommand):
         elif target == 'save':
             save_location = compiler.settings.get('builtin').get('destination', None)
             if save_location is None:
-                save_location = self.view.file_name()
+                save_location = snapshot.file_name()
                 if save_location is None or not os.path.exists(save_location):
                     # Save as...
-                    v = new_view(self.view.window(), html)
+                    v = new_view(window, html)
                     if v is not None:
                         v.run_command('save')
                 else:
@@ -1397,106 +2523,474 @@ class MarkdownPreviewCommand(sublime_plugin.TextCommand):
 
         return (tocStartIdx, tocEndIdx, '\n'.join(_s))
 
-    def temp_toc_refs(self, edit, mode='insert'):
-        TOC_STRING="<!-- temp toc -->\n[TOC]\n\n"
-        insertPos=None
+    def addParagraphNumbering(self, html):
+        dprint('Process "addParagraphNumbering" ...')
+        html = html.replace('article class="markdown-body"', 'article class="markdown-body paragraphNum"')
+        return html
+
 
-        # Load ref chapter
-        refBuf = self.load_refs(r"(.*(quellen|reference).*\.mm?d)")
-
-        # fd = open("/tmp/MarkdownPreview.refBuff", "w+")
-        # fd.writelines(refBuf)
-        # fd.close()
-
-        # refBuf = [w.replace('=C2=A0', '') for w in refBuf]
-
-        # fd = open("/tmp/MarkdownPreview.refBuffenc", "w+")
-        # fd.writelines(refBuf)
-        # fd.close()
-
-        print('Process "temp_toc_refs" with mode="{}" ...'.format(mode))
-
-        #################################################################
-        # print(refBuf)
-        if mode == 'insert':
-            ## Insert TOC and reference chapter
-            #################################################################
-            if refBuf != None:
-                tmp = self.view.find(refBuf[0], 0, sublime.LITERAL)
-                if tmp.begin() >= 0:
-                    # If a reference "chapter" already exists, find region to
-                    # be overwritten by the actual refBuf contents.
-                    # Store insert position for new reference chapter
-                    insertPos = self.temp_toc_refs(edit, 'clear')
-
-                if insertPos == None:
-                    insertPos = self.view.size()
-
-                # Temporary append the reference chapter lines.
-                self.view.insert(edit, insertPos, "" + "".join(refBuf))
+def get_build_parser(settings):
+    ''' return the parser used by the build commands '''
+    parser = settings.get('parser', 'markdown')
+    if parser == 'default':
+        parser = 'markdown'
+    return parser
+
+
+def get_compiler(parser, settings):
+    ''' return a compiler for parser '''
+    if parser == "github":
+        return GithubCompiler()
+    elif parser == 'markdown':
+        return MarkdownCompiler()
+    elif parser in settings.get("enabled_parsers", ("markdown", "github")):
+        return ExternalMarkdownCompiler(parser)
+    return MarkdownCompiler()
+
+
+def file_hash(path):
+    ''' return the sha1 of a file's contents, or None if it can't be read '''
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except (IOError, OSError):
+        return None
+
+
+class BuildManifest(object):
+    '''
+    Inputs of the documents built from a set of project folders.
+
+    For every source file the output, the build settings and the hash of
+    each input (the source, references, code imports, css, js, template
+    and embedded images) are recorded, so unchanged documents are not built
+    again.  Inputs are only hashed when their mtime or size changed.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.lock = threading.Lock()
+        try:
+            with codecs.open(path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            pass
+
+    @classmethod
+    def for_folders(cls, folders):
+        ''' return the manifest of a set of project folders '''
+        if is_ST3():
+            directory = os.path.join(sublime.cache_path(), 'Markdown Preview')
+        else:
+            directory = os.path.join(sublime.packages_path(), 'User')
+        key = hashlib.sha1(u'\n'.join(sorted(folders)).encode('utf-8')).hexdigest()
+        return cls(os.path.join(directory, 'build-%s.json' % key))
+
+    def input_changed(self, path, recorded):
+        ''' check an input against its recorded [signature, hash] '''
+        signature = file_signature(path)
+        if signature is None or recorded is None:
+            return signature is not None or recorded is not None
+        if list(signature) == recorded[0]:
+            return False
+        if file_hash(path) != recorded[1]:
+            return True
+        recorded[0] = list(signature)
+        return False
+
+    def is_current(self, source, settings_key):
+        ''' check if the output of source is up to date '''
+        with self.lock:
+            entry = self.entries.get(source)
+            outputs = self.get_outputs()
+        if entry is None or entry['settings'] != settings_key or not os.path.isfile(entry['output']):
+            return False
+        for path, recorded in entry['inputs'].items():
+            if path not in outputs and self.input_changed(path, recorded):
+                return False
+        return True
+
+    def get_outputs(self):
+        ''' return the outputs of all documents, the lock must be held '''
+        return set(entry['output'] for entry in self.entries.values())
+
+    def is_output(self, path):
+        ''' check if path is the output of a document '''
+        with self.lock:
+            return path in self.get_outputs()
+
+    def get_inputs(self, source):
+        ''' return the recorded input files of source '''
+        with self.lock:
+            entry = self.entries.get(source)
+        return [] if entry is None else list(entry['inputs'])
+
+    def record(self, source, output, settings_key, dependencies):
+        '''
+        record the inputs of a document that was just built.  Only existing
+        files are inputs: directories and paths the compiler only probed for
+        are not, and neither are the outputs of documents (linked html).
+        '''
+        with self.lock:
+            outputs = self.get_outputs()
+        outputs.add(output)
+        inputs = {}
+        for path in [source] + list(dependencies):
+            if path in inputs or path in outputs or not os.path.isfile(path):
+                continue
+            inputs[path] = [list(file_signature(path)), file_hash(path)]
+        with self.lock:
+            self.entries[source] = {'output': output, 'settings': settings_key, 'inputs': inputs}
+
+    def get_dependents(self, path):
+        ''' return the sources that have path as an input '''
+        with self.lock:
+            if path in self.get_outputs():
+                return []
+            return [source for source, entry in self.entries.items() if path in entry['inputs']]
+
+    def get_all_inputs(self):
+        with self.lock:
+            inputs = set(path for entry in self.entries.values() for path in entry['inputs'])
+            return inputs - self.get_outputs()
+
+    def discard(self, source):
+        with self.lock:
+            self.entries.pop(source, None)
+
+    def save(self):
+        with self.lock:
+            data = json.dumps(self.entries, sort_keys=True)
+        write_atomic(self.path, data.encode('utf-8'))
+
+
+class ProjectBuilder(object):
+    '''
+    Build markdown files to html with a pool of worker threads, as the
+    build command does for a single view.  Documents whose inputs did not
+    change since the last build, according to the manifest, are skipped.
+    Progress is reported by calling log with a message.
+    '''
+
+    def __init__(self, parser, settings, log, manifest=None):
+        self.parser = parser
+        self.settings = settings
+        self.log = log
+        self.manifest = manifest
+        self.settings_key = hashlib.sha1(
+            json.dumps(
+                [parser, [settings.get(name) for name in RENDER_SETTINGS]],
+                sort_keys=True, default=str
+            ).encode('utf-8')
+        ).hexdigest()
+
+    @staticmethod
+    def discover(folders, filetypes):
+        ''' return the markdown files under folders, skipping hidden directories '''
+        sources = []
+        filetypes = tuple(filetypes)
+        for folder in folders:
+            for root, dirs, files in os.walk(folder):
+                dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+                for name in sorted(files):
+                    if name.endswith(filetypes):
+                        sources.append(os.path.join(root, name))
+        return sources
+
+    def build_file(self, source):
+        ''' build one file, return the output file and the compiler '''
+        compiler = get_compiler(self.parser, self.settings)
+        html, body = compiler.run(
+            ViewSnapshot.from_file(source), True, preview=False,
+            settings=Settings('MarkdownPreview.sublime-settings', source, self.settings)
+        )
+        output = compiler.settings.get('builtin').get('destination', None)
+        if output is None:
+            output = os.path.splitext(source)[0] + '.html'
+        # Record the output before writing it, so a watcher knows the
+        # change is not one of the inputs.
+        if self.manifest is not None:
+            if body == _CANNOT_CONVERT:
+                self.manifest.discard(source)
             else:
-                print("\nNo \"Quellenangaben*.mmd\" found!")
+                self.manifest.record(source, output, self.settings_key, compiler.dependencies)
+        save_utf8_if_changed(output, html)
+        return output, compiler
+
+    def build(self, sources, workers=4, force=False):
+        ''' build sources, return the number of built, skipped and failed files '''
+        results = {'built': 0, 'skipped': 0, 'failed': 0}
+        pending = list(sources)
+        total = len(pending)
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    index = total - len(pending) + 1
+                    source = pending.pop(0)
+                if not force and self.manifest is not None and self.manifest.is_current(source, self.settings_key):
+                    with lock:
+                        results['skipped'] += 1
+                    continue
+                start_time = time.time()
+                try:
+                    output, compiler = self.build_file(source)
+                except Exception:
+                    self.log("[%d/%d] %s failed:\n%s" % (index, total, source, traceback.format_exc()))
+                    with lock:
+                        results['failed'] += 1
+                    continue
+                self.log("[%d/%d] %s -> %s (%.2fs)" % (index, total, source, output, time.time() - start_time))
+                if compiler.highlight_downgraded:
+                    self.log("        %d code block(s) exceeded the highlight budget" % compiler.highlight_downgraded)
+                with lock:
+                    results['built'] += 1
+
+        threads = [threading.Thread(target=worker) for _ in range(max(1, min(workers, total)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if self.manifest is not None:
+            self.manifest.save()
+        return results['built'], results['skipped'], results['failed']
+
+
+class InotifyMonitor(object):
+    '''
+    Report changed files of watched directories with Linux inotify.
+    Raises OSError if inotify is not available.
+    '''
 
-            # Insert temporary [TOC]
-            self.view.insert(edit, 0, TOC_STRING)
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+
+        if not sys.platform.startswith('linux'):
+            raise OSError('inotify is only available on Linux')
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.directories = {}
+        self.watched = set()
+
+    def watch(self, directory, recursive=False):
+        ''' watch a directory, optionally with its (not hidden) sub directories '''
+        if directory in self.watched or not os.path.isdir(directory):
             return
+        wd = self.libc.inotify_add_watch(self.fd, directory.encode(sys.getfilesystemencoding()), self.MASK)
+        if wd < 0:
+            return
+        self.directories[wd] = (directory, recursive)
+        self.watched.add(directory)
+        if recursive:
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                if not name.startswith('.') and os.path.isdir(path):
+                    self.watch(path, True)
+
+    def read(self, timeout):
+        ''' wait up to timeout seconds, return the changed files '''
+        import select
+        import struct
+
+        changed = []
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError:
+            return changed
+        pos = 0
+        while pos + 16 <= len(data):
+            wd, mask, cookie, length = struct.unpack_from('iIII', data, pos)
+            name = data[pos + 16:pos + 16 + length].rstrip(b'\0').decode(sys.getfilesystemencoding())
+            pos += 16 + length
+            if wd not in self.directories or not name:
+                continue
+            directory, recursive = self.directories[wd]
+            path = os.path.join(directory, name)
+            if mask & self.IN_ISDIR:
+                if recursive and mask & (self.IN_CREATE | self.IN_MOVED_TO) and not name.startswith('.'):
+                    self.watch(path, True)
+            else:
+                changed.append(path)
+        return changed
 
-        if mode == 'clear':
-            ## Remove TOC and reference chapter
-            #################################################################
-            if refBuf != None:
-                # Search the first line of reference file buffer within current view.
-                tmp = self.view.find(refBuf[0], 0, sublime.LITERAL)
-                if tmp.begin() >= 0:
-                    # If a reference "chapter" already exists, find region to
-                    # be overwritten by the actual refBuf contents.
-                    regErase = sublime.Region(tmp.begin(), self.view.size())
-                    # Remove old reference chapter.
-                    self.view.erase(edit, regErase)
-                    # Store insert position for new reference chapter
-            else:   
-                tmp=None
-            # Erase temporary TOC.
-            while self.view.find(TOC_STRING, 0, sublime.LITERAL).begin() >= 0:
-                self.view.erase(edit, self.view.find(TOC_STRING, 0, sublime.LITERAL))
-
-            # Return region which has possibly been cleared.
-            return tmp
+    def close(self):
+        os.close(self.fd)
 
-    def addParagraphNumbering(self, html):
-        dprint('Process "addParagraphNumbering" ...')
-        html = html.replace('article class="markdown-body"', 'article class="markdown-body paragraphNum"')
-        return html
 
-    ##
-    ## @brief      Loads references from references chapter markdown file.
-    ##
-    ## @param      self          this.
-    ## @param      refFilePatt   Regex pattern for references chapter file name.
-    ##
-    ## @return     String buffer or None
-    ##
-    def load_refs(self, refFilePatt=r"(.*quellen.*\.mm?d)"):
-        mdFileDir=os.path.dirname(self.view.file_name())
-        refFile=None
+class PollMonitor(object):
+    ''' Report changed files by comparing their mtime and size every interval. '''
 
-        # Search pwd for a markdown file "references" (Quellenangaben).
-        for file in os.listdir(os.path.dirname(self.view.file_name())):
-            m=re.match(refFilePatt, file, re.I)
-            if m == None:
+    def __init__(self, interval, get_files):
+        self.interval = interval
+        self.get_files = get_files
+        self.signatures = self.scan()
+
+    def scan(self):
+        return dict((path, file_signature(path)) for path in self.get_files())
+
+    def watch(self, directory, recursive=False):
+        pass
+
+    def read(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        signatures = self.scan()
+        changed = [
+            path for path in set(signatures) | set(self.signatures)
+            if signatures.get(path) != self.signatures.get(path)
+        ]
+        self.signatures = signatures
+        return changed
+
+    def close(self):
+        pass
+
+
+class Watcher(object):
+    '''
+    Rebuild documents of a set of folders when they change.
+
+    Changes are reported by inotify, or by polling where it is not
+    available.  A changed markdown file is rebuilt, and so is every
+    document that has a changed file (references, code imports, css,
+    template, images) as an input in the manifest.  Each document is built
+    once its files were quiet for delay seconds, through a bounded queue
+    served by a pool of worker threads.
+    '''
+
+    def __init__(self, folders, builder, filetypes, workers=2, delay=0.5, queue_size=64, interval=1.0):
+        self.folders = folders
+        self.builder = builder
+        self.manifest = builder.manifest
+        self.filetypes = tuple(filetypes)
+        self.workers = workers
+        self.delay = delay
+        self.interval = interval
+        self.queue = Queue(queue_size)
+        self.pending = {}
+        self.queued = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.threads = []
+
+    def get_files(self):
+        ''' files watched by polling: the sources and all known inputs '''
+        return set(ProjectBuilder.discover(self.folders, self.filetypes)) | self.manifest.get_all_inputs()
+
+    def watch_inputs(self):
+        ''' watch the directories of inputs outside of the folders '''
+        for path in self.manifest.get_all_inputs():
+            self.monitor.watch(os.path.dirname(path))
+
+    def start(self):
+        try:
+            self.monitor = InotifyMonitor()
+            for folder in self.folders:
+                self.monitor.watch(folder, True)
+            method = 'inotify'
+        except (OSError, AttributeError):
+            self.monitor = PollMonitor(self.interval, self.get_files)
+            method = 'polling'
+        self.builder.log("Watching %s (%s)" % (', '.join(self.folders), method))
+
+        self.threads = [threading.Thread(target=self.monitor_loop)]
+        self.threads += [threading.Thread(target=self.worker) for _ in range(max(1, self.workers))]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.builder.log("Stopped watching %s" % ', '.join(self.folders))
+
+    def changed(self, path):
+        ''' schedule the documents affected by a changed file '''
+        # Outputs written by the builder are not inputs of any document
+        if self.manifest.is_output(path):
+            return
+        targets = self.manifest.get_dependents(path)
+        if path.endswith(self.filetypes) and path not in targets:
+            targets.append(path)
+        deadline = time.time() + self.delay
+        with self.lock:
+            for target in targets:
+                self.pending[target] = deadline
+
+    def flush(self):
+        ''' queue the documents that were quiet long enough, return the next deadline '''
+        now = time.time()
+        next_deadline = now + self.interval
+        with self.lock:
+            for path, deadline in sorted(self.pending.items(), key=lambda item: item[1]):
+                if deadline > now:
+                    next_deadline = min(next_deadline, deadline)
+                    continue
+                if path not in self.queued:
+                    try:
+                        self.queue.put_nowait(path)
+                    except Full:
+                        # Try again once the workers caught up
+                        next_deadline = min(next_deadline, now + self.delay)
+                        break
+                    self.queued.add(path)
+                del self.pending[path]
+        return next_deadline
+
+    def monitor_loop(self):
+        # Bring the outputs up to date before waiting for changes
+        self.builder.build(ProjectBuilder.discover(self.folders, self.filetypes), self.workers)
+        self.watch_inputs()
+        while not self.stopped.is_set():
+            timeout = max(0, self.flush() - time.time())
+            for path in self.monitor.read(timeout):
+                self.changed(path)
+        for _ in range(max(1, self.workers)):
+            self.queue.put(None)
+        self.monitor.close()
+
+    def worker(self):
+        while True:
+            source = self.queue.get()
+            if source is None:
+                return
+            with self.lock:
+                self.queued.discard(source)
+            if not os.path.isfile(source):
+                self.manifest.discard(source)
                 continue
-            else:
-                refFile=os.path.join(mdFileDir, m.group(0))
-
-        # refBuf = self.load_refs_from_file(edit, refFile)
-        if refFile != None:
-            # If a reference file has been found, read contents to line buffer.
-            fd = open(refFile, "r+")
-            refBuf = fd.readlines();
-            fd.close();
-            return refBuf
-        else:
-            return None
+            if self.manifest.is_current(source, self.builder.settings_key):
+                continue
+            start_time = time.time()
+            try:
+                output = self.builder.build_file(source)[0]
+            except Exception:
+                self.builder.log("%s failed:\n%s" % (source, traceback.format_exc()))
+                continue
+            self.manifest.save()
+            self.watch_inputs()
+            self.builder.log("%s -> %s (%.2fs)" % (source, output, time.time() - start_time))
+
+
+watchers = {}
 
 
 class MarkdownBuildCommand(sublime_plugin.WindowCommand):
@@ -1531,10 +3025,8 @@ class MarkdownBuildCommand(sublime_plugin.WindowCommand):
 
         self.init_panel()
 
-        settings = sublime.load_settings('MarkdownPreview.sublime-settings')
-        parser = settings.get('parser', 'markdown')
-        if parser == 'default':
-            parser = 'markdown'
+        settings = get_snapshot()
+        parser = get_build_parser(settings)
 
         target = settings.get('build_action', 'build')
         if target in ('browser', 'sublime', 'clipboard', 'save'):
@@ -1552,16 +3044,12 @@ class MarkdownBuildCommand(sublime_plugin.WindowCommand):
 
         self.puts("Compiling %s..." % mdfile)
 
-        if parser == "github":
-            compiler = GithubCompiler()
-        elif parser == 'markdown':
-            compiler = MarkdownCompiler()
-        elif parser in settings.get("enabled_parsers", ("markdown", "github")):
-            compiler = ExternalMarkdownCompiler(parser)
-        else:
-            compiler = MarkdownCompiler()
+        compiler = get_compiler(parser, settings)
 
-        html, body = compiler.run(view, True, preview=False)
+        html, body = compiler.run(
+            view, True, preview=False,
+            settings=Settings('MarkdownPreview.sublime-settings', mdfile, settings)
+        )
 
         htmlfile = compiler.settings.get('builtin').get('destination', None)
 
@@ -1573,19 +3061,119 @@ class MarkdownBuildCommand(sublime_plugin.WindowCommand):
         elapsed = time.time() - start_time
         if body == _CANNOT_CONVERT:
             self.puts(_CANNOT_CONVERT)
+        if compiler.highlight_downgraded:
+            self.puts("%d code block(s) exceeded the highlight budget" % compiler.highlight_downgraded)
         self.puts("[Finished in %.1fs]" % (elapsed))
         sublime.status_message("Build finished")
 
 
+class MarkdownBuildProjectCommand(MarkdownBuildCommand):
+    ''' build all markdown files of the project folders, skipping unchanged ones '''
+
+    def run(self, force=False):
+        start_time = time.time()
+        self.init_panel()
+
+        settings = get_snapshot()
+        if settings.get("show_panel_on_build", True):
+            self.window.run_command("show_panel", {"panel": "output.markdown"})
+
+        folders = self.window.folders()
+        if not folders:
+            self.puts("There are no project folders to build.")
+            return
+
+        sources = ProjectBuilder.discover(folders, settings.get('markdown_filetypes', []))
+        builder = ProjectBuilder(
+            get_build_parser(settings), settings,
+            lambda message: sublime.set_timeout(lambda: self.puts(message), 0),
+            BuildManifest.for_folders(folders)
+        )
+        self.puts("Building %d markdown file(s)..." % len(sources))
+
+        def build():
+            built, skipped, failed = builder.build(sources, settings.get('build_workers', 4), force)
+            message = "%d built, %d up to date, %d failed" % (built, skipped, failed)
+            elapsed = time.time() - start_time
+            sublime.set_timeout(lambda: self.puts("%s\n[Finished in %.1fs]" % (message, elapsed)), 0)
+            sublime.set_timeout(lambda: sublime.status_message("Build finished: " + message), 0)
+
+        run_async(build)
+
+
+def start_watcher(key, folders, log):
+    ''' start watching folders, unless a watcher with key is already running '''
+    if key in watchers:
+        return
+    settings = get_snapshot()
+    filetypes = settings.get('markdown_filetypes', [])
+    builder = ProjectBuilder(get_build_parser(settings), settings, log, BuildManifest.for_folders(folders))
+    watcher = watchers[key] = Watcher(
+        folders, builder, filetypes,
+        workers=settings.get('build_workers', 4),
+        delay=settings.get('watch_delay', 500) / 1000.0,
+        queue_size=settings.get('watch_queue_size', 64),
+        interval=settings.get('watch_poll_interval', 1000) / 1000.0
+    )
+    watcher.start()
+
+
+def stop_watcher(key):
+    watcher = watchers.pop(key, None)
+    if watcher is not None:
+        watcher.stop()
+
+
+def plugin_unloaded():
+    for key in list(watchers):
+        stop_watcher(key)
+    github_pool.stop()
+    ExternalMarkdownCompiler.stop_workers()
+
+
+class MarkdownWatchCommand(MarkdownBuildCommand):
+    '''
+    Toggle watching the project folders: documents are rebuilt whenever
+    they, or files they use, change on disk.
+    '''
+
+    def run(self, stop=False):
+        self.init_panel()
+        key = ('window', self.window.id())
+        if stop or key in watchers:
+            stop_watcher(key)
+            return
+
+        folders = self.window.folders()
+        if get_snapshot().get("show_panel_on_build", True):
+            self.window.run_command("show_panel", {"panel": "output.markdown"})
+        if not folders:
+            self.puts("There are no project folders to watch.")
+            return
+        start_watcher(key, folders, lambda message: sublime.set_timeout(lambda: self.puts(message), 0))
+
+
+class MarkdownWatchFoldersCommand(sublime_plugin.ApplicationCommand):
+    '''
+    Headless watch mode: watch the given folders without a window, and
+    log to the console.
+    '''
+
+    def run(self, folders, stop=False):
+        key = ('folders',) + tuple(sorted(folders))
+        if stop:
+            stop_watcher(key)
+        else:
+            start_watcher(key, folders, lambda message: print('Markdown Preview: %s' % message))
+
+
 from pprint import pprint as pp
 from mdLibs import mdosd as osd
 from sublime import error_message
 from threading import Thread
 from os.path import splitext
-from tempfile import NamedTemporaryFile
-from shutil import copy2, move
-from datetime import datetime
-import inspect, ast, json
+from shutil import move
+import ast, json
 
 # Try to import sublime_diagram_plugin
 from sublime_diagram_plugin import diagram as diag
@@ -1650,10 +3238,9 @@ class MarkdownFoldCommand(sublime_plugin.TextCommand):
             return len(re.findall('^#+', view.substr(view.line(view.sel()[0])))[0])
         except (ValueError,IndexError):
             if k == maxReverseLines:
-                dprint('No matches for reverse finding pattern \'{}\' '.format(pattern) +
-                    'within the last {} lines!'.format(maxReverseLines))
+                dprint('No matches for reverse finding pattern within the last lines:', pattern, maxReverseLines)
             else:
-                dprint('No matches for reverse find pattern "{}"'.format(pattern))
+                dprint('No matches for reverse find pattern', pattern)
             return int(-1)
 
 
@@ -1758,44 +3345,89 @@ class AddHeaderFooter(object):
         return self.html
 
 
+class TocRefs(object):
+    TOC_STRING="<!-- temp toc -->\n[TOC]\n\n"
+    REF_FILE_PATTERN=r"(.*(quellen|reference).*\.mm?d)"
+
+    '''
+    Chapter compile: prepends a [TOC] to the markdown source and appends
+    the references chapter found next to the markdown file.  Works on the
+    source text, the view is not modified.
+    '''
+    def __init__(self, file_name, add_dependency=None):
+        self.mdFileDir=os.path.dirname(file_name)
+        self.add_dependency = add_dependency
+
+    def load_refs(self, refFilePatt=REF_FILE_PATTERN):
+        '''
+        Loads references from references chapter markdown file.
+        Returns the lines of the file or None.
+        '''
+        refFile=None
+
+        # Search pwd for a markdown file "references" (Quellenangaben).
+        for file in os.listdir(self.mdFileDir):
+            m=re.match(refFilePatt, file, re.I)
+            if m != None:
+                refFile=os.path.join(self.mdFileDir, m.group(0))
+
+        if refFile == None:
+            return None
+
+        if self.add_dependency is not None:
+            self.add_dependency(refFile)
+        # If a reference file has been found, read contents to line buffer.
+        fd = open(refFile, "r")
+        refBuf = fd.readlines()
+        fd.close()
+        return refBuf
+
+    def expand(self, text):
+        print('Process "temp_toc_refs" ...')
+
+        # Load ref chapter
+        refBuf = self.load_refs()
+
+        if refBuf:
+            # If a reference "chapter" already exists in the source, it is
+            # replaced by the actual refBuf contents.
+            pos = text.find(refBuf[0])
+            if pos >= 0:
+                text = text[:pos].replace(self.TOC_STRING, '')
+
+            # Append the reference chapter lines.
+            text += "".join(refBuf)
+        else:
+            print("\nNo \"Quellenangaben*.mmd\" found!")
+
+        # Prepend [TOC]
+        return self.TOC_STRING + text
+
+
 class CodeImportBlock(object):
-    def __init__(self, keyRegStr, attrsRegStr, adjRows, mdFileDirname):
-        settings = sublime.load_settings('MarkdownPreview.sublime-settings')
-        self.keyReg = keyRegStr[0]
-        self.keyStr = keyRegStr[1]
-        self.attrsReg = attrsRegStr[0]
+    def __init__(self, keyStr, attrsStr, adjRows, mdFileDirname):
+        settings = get_snapshot()
+        self.keyStr = keyStr
+        self.attrsStr = attrsStr
         self.adjacentRows = adjRows
         self.attrs=dict()
 
-        # if self.attrsReg:
-        if type(attrsRegStr[1]).__name__ == 'list':
-            self.attrsStr = attrsRegStr[1]
-        else:
-            self.attrsStr = [attrsRegStr[1]]
-        # else:
-        #     self.attrsStr = None
-
         self.attrs.update({"path":
             self.keyStr.split(':')[1].strip('[\" ]').lstrip('[.\/]')})
 
         # Check for optional attributes
-        if self.attrsReg:
-            for attr in self.attrsStr:
-                if '@codeimport_nocomments' in attr:
-                    self.attrs.update({"comments": "remove"})
-
-        sourceFile = os.path.join(mdFileDirname, self.attrs["path"])
-        dprint('sourceFile: ', sourceFile)
+        for attr in self.attrsStr:
+            if '@codeimport_nocomments' in attr:
+                self.attrs.update({"comments": "remove"})
 
-        if not os.path.exists(sourceFile):
-            osd.crit('Path {} doesn\'t exist'.format(sourceFile)).send()
-            return
+        self.sourceFile = os.path.join(mdFileDirname, self.attrs["path"])
+        dprint('sourceFile: ', self.sourceFile)
 
-        fd = open(sourceFile, 'r+')
-        if fd == None:
-            osd.crit('File descriptor open returns None').send()
+        if not os.path.exists(self.sourceFile):
+            osd.crit('Path {} doesn\'t exist'.format(self.sourceFile)).send()
             return
 
+        fd = open(self.sourceFile, 'r')
         self.codeLines = fd.readlines()
         fd.close()
 
@@ -1810,108 +3442,85 @@ class CodeImportBlock(object):
                 self.codeLines.insert(0, '```\n')
             self.codeLines.append('```\n')
 
+    def get_code(self):
+        ''' Return the code to insert, or None if the file could not be read. '''
+        if not hasattr(self, 'codeLines'):
+            return None
+
+        # Join code lines
+        code = ''.join(self.codeLines)
+
+        # Remove comments if optional attribute @codeimport_nocomments found
+        if 'comments' in self.attrs.keys():
+            if self.attrs['comments'] == 'remove':
+                code = re.sub('(?s)\/\*.*?\*\/\n', '', code)
+                # code = re.sub('^\s*\/\/', '', code)
+                code = re.sub(' *\/\/[^\!].*\n', '', code)
+                # Remove multiple empty lines except of the first
+                code = re.sub('\n{3,}', '\n\n', code)
+        return code
+
 
 class CodeImport(object):
     ATTRPREFIXES=['@codeimport:', '@codeimport_nocomments']
     mdFileDirname=''
 
-    """docstring for ImportExtSrcs"""
-    def __init__(self, view, edit):
-        if view.file_name() == None:
-            view.run_command('save')
-            dprint('Only saved files can be processed!')
-            return
+    '''
+    Expands @codeimport lines of a markdown source to the code of the
+    imported file.  Works on the source text, the view is not modified.
+    '''
+    def __init__(self, file_name, add_dependency=None):
+        self.mdFileDirname=os.path.dirname(file_name)
+        self.add_dependency = add_dependency
 
-        self.view = view
-        self.edit = edit
-        self.mdFileDirname=os.path.dirname(view.file_name())
-        self.blkObj=[]
+    def expand(self, text):
+        if self.ATTRPREFIXES[0] not in text:
+            return text
 
-        ''' Start to import code blocks '''
         dprint('Invoke "code import" processing...')
 
-        keyRegs = [self.view.line(keyr) for keyr in self.view.find_all(
-            self.ATTRPREFIXES[0])]
-
-        # Filter all regions with scope comment.block.html  
-        keyRegs = list(filter(lambda x: 'comment.block.html' not in 
-            self.view.scope_name(x.begin()), keyRegs))
-
-        for key in keyRegs:
-            ''' Check for optional attributes.'''
-            attrStrs = []
-            attrCtr = 0
-            attrs = self.view.line(key.end()+1)
+        # Directives within html comments are not expanded
+        comments = [m.span() for m in re.finditer(r'<!--.*?-->', text, re.DOTALL)]
+
+        lines = text.splitlines(True)
+        result = []
+        offset = 0
+        i = 0
+        while i < len(lines):
+            line = lines[i]
+            pos = line.find(self.ATTRPREFIXES[0])
+            if pos == -1 or any(b <= offset + pos < e for b, e in comments):
+                result.append(line)
+                offset += len(line)
+                i += 1
+                continue
 
-            if self.ATTRPREFIXES[1] not in \
-                self.view.substr(self.view.line(attrs.end()+attrCtr)):
-                attrs = []
-            else:
-                while self.ATTRPREFIXES[1] in \
-                    self.view.substr(self.view.line(attrs.end()+attrCtr)):
-                    attrStrs.append(self.view.substr(self.view.line(attrs.end()+attrCtr)))
-                    attrs = attrs.cover(self.view.line(attrs.end()+attrCtr))
-                    attrCtr += 1
-
-            if attrStrs:
-                # Test if the @codeimport attribute is surrounded by fancy-code markers ```
-                attrsRegStr_=[attrs, self.view.substr(attrs)]
-                adjRows=(
-                    self.view.substr(self.view.line(key.begin()-1)),
-                    self.view.substr(self.view.line(attrs.end()+1))
-                    )
-            else:
-                attrsRegStr_=[None, None]
-                adjRows=(
-                    self.view.substr(self.view.line(key.begin()-1)),
-                    self.view.substr(self.view.line(key.end()+1))
-                    )
-
-            self.blkObj.append(
-                CodeImportBlock(
-                    keyRegStr=[key, self.view.substr(key)],
-                    attrsRegStr=attrsRegStr_,
-                    adjRows=adjRows,
-                    mdFileDirname=self.mdFileDirname
-                    )
+            # Check for optional attributes
+            j = i + 1
+            while j < len(lines) and self.ATTRPREFIXES[1] in lines[j]:
+                j += 1
+
+            keyStr = line.rstrip('\r\n')
+            block = CodeImportBlock(
+                keyStr=keyStr,
+                attrsStr=lines[i + 1:j],
+                adjRows=(lines[i - 1] if i else '', lines[j] if j < len(lines) else ''),
+                mdFileDirname=self.mdFileDirname
                 )
+            if self.add_dependency is not None:
+                self.add_dependency(block.sourceFile)
+            code = block.get_code()
+            if code is None:
+                result.append(line)
+                offset += len(line)
+                i += 1
+                continue
 
-    def process(self, view, edit):
-        print('Process "CodeImport" ...')
-        # Create temporary backup of src file
-        self.orig_src = create_temporary_copy(view, preserve_ext=True)
-
-        # Store viewport position
-        self.orig_viewport = self.view.viewport_position()
-
-        for o in reversed(self.blkObj):
-            # Remove optional attributes lines
-            if o.attrsReg:
-                self.view.erase(edit, self.view.full_line(o.attrsReg))
-
-            # Join code lines
-            code = ''.join(o.codeLines)
-
-            # Remove comments if optional attribute @codeimport_nocomments found
-            if 'comments' in o.attrs.keys():
-                if o.attrs['comments'] == 'remove':
-                    code = re.sub('(?s)\/\*.*?\*\/\n', '', code)
-                    # code = re.sub('^\s*\/\/', '', code)
-                    code = re.sub(' *\/\/[^\!].*\n', '', code)
-                    # Remove multiple empty lines except of the first
-                    code = re.sub('\n{3,}', '\n\n', code)
-
-            view.replace(edit, o.keyReg, code)
-
-    def unprocess(self):
-        '''Restore original source file contents'''
-        restore_temporary_copy(self.view, self.edit, self.orig_src)
-
-        # Register a delayed restoreViewport callbac
-        sublime.set_timeout(self.restoreViewport, 1)
-
-    def restoreViewport(self):
-        self.view.set_viewport_position(self.orig_viewport)
+            # Replace the directive line, drop the attribute lines
+            result.append(code + line[len(keyStr):])
+            offset += sum(len(l) for l in lines[i:j])
+            i = j
+        return ''.join(result)
 
 
 class UmlBlock(object):
@@ -1923,182 +3532,249 @@ class UmlBlock(object):
         self.diagram = diagram
 
     def get_replace_reg(self):
-        if not self.blk_reg:
-            dprint('Error, self.blk_reg is None')
-            return None
-
-        # If no diag attrs where given, replace uml block region
+        '''
+        Return the (begin, end) offsets of the uml block, and of the diag
+        attribute lines following it if any.
+        '''
         if not self.attr_reg:
             return self.blk_reg
-
-        attributes_region = self.attr_reg[0]
-        for reg in self.attr_reg:
-            attributes_region = attributes_region.cover(reg)
-
-        # If diag attr found, cover regions of uml block and attr block
-        return sublime.Region(
-            self.blk_reg.begin(),
-            self.blk_reg.cover(attributes_region).end()
-            )
+        return (self.blk_reg[0], self.attr_reg[-1][1])
 
 
-class InlineUmlDiagram(sublime_plugin.TextCommand):
+class InlineUmlDiagram(object):
     ATTRPREFIX='@diag_'
+    processor_locks = {}
+    processor_locks_lock = threading.Lock()
     '''
     Provides inline processing of PlantUML blocks. Uses sublime_diagram_plugin
-    methods for inline UML block extraction and rendering. Additional inline
-    diagram attributes can be used for html-image-tag customizations (i.e.
-    scaling, style, alignment, ...). Each resulting markdown or html image tag,
-    substitutes it's corresponding PlantUML block in the source view befor the
-    Markdown Preview compiler call is processed. If not disabled in user
-    settings, undo_inline_subst() method reverts the markdown document to the
-    state before UML blocks has been processed inline.
+    processors for rendering. Additional inline diagram attributes can be
+    used for html-image-tag customizations (i.e. scaling, style, alignment,
+    ...). Each resulting markdown or html image tag substitutes its
+    corresponding PlantUML block in the source text before it is converted;
+    the view is not modified. Only the first active processor (PlantUML, the
+    one sublime_diagram_plugin ships) renders the blocks, because the
+    processors' own extract_blocks() work on a view, not on text.
     '''
-    def process(self, view, edit):
-        if self.view.file_name() == None:
-            self.view.run_command('save')
-            dprint('Only saved files can be processed!')
-            return False
-
-        self.edit = edit
+    def __init__(self, file_name, variables=None, add_dependency=None, cleanup=True):
+        self.file_name = file_name
+        self.variables = variables or {}
+        self.add_dependency = add_dependency
+        # Unused diagrams can only be told apart when the whole document is expanded
+        self.cleanup = cleanup
+
+    def extract_blocks(self, text):
+        '''
+        Return the (begin, end) offsets of the @start... to @end... blocks,
+        as whole lines without the final line break.
+        '''
+        blocks = []
+        pos = 0
+        while True:
+            start = text.find('@start', pos)
+            if start == -1:
+                break
+            end = text.find('@end', start)
+            if end == -1:
+                break
+            begin = text.rfind('\n', 0, start) + 1
+            end = text.find('\n', end)
+            if end == -1:
+                end = len(text)
+            blocks.append((begin, end))
+            pos = end
+        return blocks
+
+    def expand(self, text):
         ''' Starts inline PlantUML block processing '''
-        print('Invoke PlantUML inline diagram processing...')
-
-        # Create temporary backup of src file
-        # self.orig_src = self.create_temporary_copy(preserve_ext=True)
-        self.orig_src = create_temporary_copy(view, preserve_ext=True)
-        print('self.orig_src: ', self.orig_src.name)
+        if '@start' not in text:
+            return text
 
-        srcFile = 'untitled.txt'
-        if view.file_name() is not None:
-            srcFile = view.file_name()
+        print('Invoke PlantUML inline diagram processing...')
 
-        # Prepare sublime_diagram_plugin for Plant UML block extraction +
-        # rendering process
+        # Prepare sublime_diagram_plugin for Plant UML block rendering
         diag.setup()
-        ACTIVE_PROCESSORS = diag.ACTIVE_PROCESSORS
-        diags = []
-
-        for processor in ACTIVE_PROCESSORS:
-            blocks = []
-
-            # Extract code blocks surrounded by ```
-            cblocks = extract_code_blocks(self.view,)
-
-            # Extract PlantUML code blocks via sublime_diagram_plugin methode
-            puml_blocks = processor.extract_blocks(view)
-
-            for block in puml_blocks:
-                add = True
-                for cblock in cblocks:
-                    # Check if PlantUML block is implemented as fancy "code block"
-                    if block.intersects(cblock):
-                        add = False
-                        break
-
-                if add:
-                    # Extract optional PlantUML diagram attributes
-                    attrsObj = extract_attrs(self.view, block, self.ATTRPREFIX)
-                    dprint('found %i diag attrs: ' % len(attrsObj[0]), attrsObj[0])
+        if not diag.ACTIVE_PROCESSORS:
+            return text
+        # The @start...@end blocks are PlantUML syntax, see the class docstring
+        processor = diag.ACTIVE_PROCESSORS[0]
+
+        # Extract code blocks surrounded by ```
+        cblocks = extract_code_blocks(text)
+
+        blocks = []
+        for begin, end in self.extract_blocks(text):
+            # Skip PlantUML blocks implemented as fancy "code block"
+            if any(begin < c_end and c_begin < end for c_begin, c_end in cblocks):
+                continue
 
-                    _b_= UmlBlock(
-                        blk_reg=block,
-                        blk_str=view.substr(block),
-                        blk_attr=attrsObj,
-                        )
-                    blocks.append(_b_)
-                    dprint('Blocks:')
-                    pp(_b_.get_replace_reg())
+            # Extract optional PlantUML diagram attributes
+            attrsObj = extract_attrs(text, end, self.ATTRPREFIX)
+            dprint('found diag attrs:', len(attrsObj[0]), attrsObj[0])
 
-            if blocks:
-                diags.append((processor, blocks,))
+            _b_= UmlBlock(
+                blk_reg=(begin, end),
+                blk_str=text[begin:end],
+                blk_attr=attrsObj,
+                )
+            blocks.append(_b_)
+            dprint('Blocks:', _b_.get_replace_reg())
 
         # Return if no PlantUML code block found
-        if not diags:
+        if not blocks:
             dprint('No PlantUML blocks found!')
-            return False
-
-        dprint('Found %i PlantUML blocks.' % len(diags[0][1]))
-
-        # Process extracted PlantUML blocks via sublime_diagram_plugin
-        diagram_files=[]
-        for processor, uml_blocks in diags:
-            diagram_files.extend(processor.process(
-                sourceFile=splitext(srcFile)[0] + '-',
-                text_blocks=[blk.blk_str for blk in uml_blocks]
-                ))
+            return text
 
-        for k in range(len(diagram_files)):
-            blk = uml_blocks[k]
+        dprint('Found PlantUML blocks:', len(blocks))
 
-            diagram_files[k].name = self.move_to_export_dir(diagram_files[k], k)
-
-            blk.diagram = diagram_files[k]
-            blk.line_count = (int(view.rowcol(blk.blk_reg.end())[0]) -
-            int(view.rowcol(blk.blk_reg.begin())[0]))
-
-        del diags, diagram_files
+        # Render the PlantUML blocks via sublime_diagram_plugin, or reuse
+        # the diagrams rendered before
+        paths = self.render_diagrams(
+            [(processor, blk.blk_str) for blk in blocks],
+            self.get_export_dir(), os.path.basename(self.file_name), self.cleanup
+        )
 
-        # Generate markdown/html image tag and replace UML blocks temporary
-        for blk in reversed(uml_blocks):
+        # Generate markdown/html image tag and replace UML blocks
+        result = []
+        pos = 0
+        for blk, path in zip(blocks, paths):
+            if path is None:
+                continue
+            if self.add_dependency is not None:
+                self.add_dependency(path)
+            blk.diagram = path
+            begin, end = blk.get_replace_reg()
             img_tag = self.gen_image_tag(blk, self.get_default_style_dict())
             dprint(img_tag)
-            view.replace(edit, blk.get_replace_reg(), img_tag)
+            result.append(text[pos:begin])
+            result.append(img_tag)
+            pos = end
+        result.append(text[pos:])
+        return ''.join(result)
 
-        return True
-
-    def unprocess(self):
-        restore_temporary_copy(self.view, self.edit, self.orig_src)
-
-    def move_to_export_dir(self, diagram_file, suffix):
+    def get_export_dir(self):
         '''
-        Move/rename diagram_file to export dir specified in settings
-        "inline_diagram_export_dir"
+        Return the export dir specified in settings "inline_diagram_export_dir".
+        The markdown file's directory is used if it is not set, or uses a
+        variable that is not known (e.g. ${project_path} without a project).
         '''
-        exportDir = sublime.load_settings(
-            'MarkdownPreview.sublime-settings').get(
-            'inline_diagram_export_dir')
+        exportDir = get_snapshot().get('inline_diagram_export_dir')
 
         # Expand variables
-        exportDir = sublime.expand_variables(exportDir,
-            self.view.window().extract_variables())
+        if exportDir:
+            if all(name in self.variables for name in re.findall(r'\$\{?(\w+)', exportDir)):
+                exportDir = sublime.expand_variables(exportDir, self.variables)
+            else:
+                exportDir = None
 
         if not exportDir:
-            exportDir = os.path.dirname(self.view.file_name())
+            exportDir = os.path.dirname(self.file_name)
         if not os.path.exists(exportDir):
             os.makedirs(exportDir)
+        return exportDir
+
+    @staticmethod
+    def get_diagram_key(processor, text):
+        '''
+        Hash of a diagram's text and the renderer.  The renderer is described
+        by the processor class and its plain attributes (paths, versions,
+        charset...).
+        '''
+        renderer = sorted(
+            (k, v) for k, v in vars(processor).items()
+            if isinstance(v, (bool, int, float, str, unicode_str))
+        )
+        return hashlib.sha1(
+            json.dumps([type(processor).__name__, renderer, text], default=str).encode('utf-8')
+        ).hexdigest()
+
+    @classmethod
+    def get_processor_lock(cls, processor):
+        ''' Return the lock serializing the calls of a processor. '''
+        with cls.processor_locks_lock:
+            return cls.processor_locks.setdefault(id(processor), threading.Lock())
+
+    @classmethod
+    def render_diagrams(cls, jobs, exportDir, prefix, cleanup=True):
+        '''
+        Return the diagram files of a list of (processor, text) jobs.
+
+        Diagrams are stored in exportDir as "<prefix>-diag-<hash>.<ext>",
+        with the hash of get_diagram_key.  Existing files are reused as they
+        are; the others are rendered by worker threads, one at a time per
+        processor.  With cleanup, the diagram files of the document that are
+        no longer used are removed; jobs must then cover the whole document.
+        The path of a diagram that failed to render is None.
+        '''
+        existing = {}
+        for name in os.listdir(exportDir):
+            if name.startswith(prefix + '-diag-'):
+                existing[splitext(name)[0]] = os.path.join(exportDir, name)
+
+        stems = []
+        paths = []
+        missing = {}
+        for processor, text in jobs:
+            stem = '{0}-diag-{1}'.format(prefix, cls.get_diagram_key(processor, text)[:16])
+            stems.append(stem)
+            paths.append(existing.get(stem))
+            if stem not in existing:
+                missing[stem] = (processor, text)
+        dprint('PlantUML diagrams: %d cached, %d to render' % (len(jobs) - len(missing), len(missing)))
+
+        rendered = {}
+        pending = list(missing.items())
+        lock = threading.Lock()
+
+        def render():
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    stem, (processor, text) = pending.pop()
+                try:
+                    # Processors are not known to be thread safe
+                    with cls.get_processor_lock(processor):
+                        diagram_file = processor.process(
+                            sourceFile=os.path.join(tempfile.gettempdir(), stem + '-'),
+                            text_blocks=[text]
+                        )[0]
+                    path = os.path.join(exportDir, stem + splitext(diagram_file.name)[1])
+                    move(diagram_file.name, path)
+                    rendered[stem] = path
+                except Exception:
+                    print(traceback.format_exc())
 
-        diagFilePath = os.path.join(exportDir,
-            '{0}-diag_{2}{1}'.format(
-                splitext(os.path.basename(self.view.file_name()))[0],
-                splitext(os.path.basename(diagram_file.name))[1], suffix))
+        workers = max(1, min(get_snapshot().get('inline_diagram_workers', 4), len(pending)))
+        threads = [threading.Thread(target=render) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
 
-        # Move file diagFilePath to temp + timestring if exists
-        if os.path.isfile(diagFilePath):
-            move(diagFilePath, os.path.join(
-                tempfile.gettempdir(), os.path.basename(diagFilePath) +
-                datetime.now().strftime('%Y-%m-%d_%H%M%S_%f')))
+        if cleanup:
+            for stem, path in existing.items():
+                if stem not in stems:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
 
-        # Move diag file
-        move(diagram_file.name, diagFilePath)
-        return diagFilePath
+        return [path if path is not None else rendered.get(stem) for stem, path in zip(stems, paths)]
 
     def get_default_style_dict(self):
         '''
         Returns dict for default style attributes, even if no
         "inline_diagram_default_style" has been set in user settings.
         '''
-        defaultDict = sublime.load_settings(
-            'MarkdownPreview.sublime-settings').get(
-            'inline_diagram_default_style')
+        defaultDict = get_snapshot().get('inline_diagram_default_style')
 
         # Check if user setting contains default markdown/html tag
         if type(defaultDict).__name__ != "dict":
             if not defaultDict:
                 dprint('No "inline_diagram_default_style" declared in settings.')
             else:
-                dprint('User settings "inline_diagram_default_style" has type "{0!s}", must be "dict".'.
-                    format(type(defaultDict).__name__))
+                dprint('User settings "inline_diagram_default_style" must be "dict", found:',
+                    type(defaultDict).__name__)
 
             defaultDict = {
             "src":   "",
@@ -2106,7 +3782,8 @@ class InlineUmlDiagram(sublime_plugin.TextCommand):
             "style": {},
             "title": "",
             }
-        return defaultDict
+        # The dict is shared with the settings snapshot, gen_image_tag modifies it
+        return dict(defaultDict)
 
     # def extract_diagram_attrs(self, block):
     #     '''
@@ -2152,7 +3829,7 @@ class InlineUmlDiagram(sublime_plugin.TextCommand):
 
         if 'src' not in defas.keys():
             defas.update({'src': ''})
-        defas['src'] = '{0!s}'.format(uml_block.diagram.name)
+        defas['src'] = '{0!s}'.format(uml_block.diagram)
 
         # If current uml_block has optional attributes dict...
         if uml_block.attr_dict:
@@ -2199,28 +3876,6 @@ class InlineUmlDiagram(sublime_plugin.TextCommand):
 
         return str('<img {0!s} style="{1!s}"/>'.format(imgAttrsStr, imgStyleStr))
 
-    # def create_temporary_copy(self, preserve_ext=False):
-        '''
-        Copies the source file into a temporary file. Returns a
-        _TemporaryFileWrapper, whose destructor deletes the temp file (i.e. the
-        temp file is deleted when the object goes out of scope).
-        '''
-        tf_suffix=''
-        if preserve_ext:
-            if self.view.file_name() != None:
-                tf_suffix = splitext(self.view.file_name())[1]
-            else:
-                tf_suffix = 'None'
-        tf = NamedTemporaryFile(suffix=tf_suffix, delete=False)
-        save_utf8(tf.name, self.view.substr(sublime.Region(0, self.view.size())))
-        return tf
-
-    # def undo_inline_subst(self, edit):
-    #     '''
-    #     Undo inline replacements.
-    #     '''
-    #     self.view.replace(edit, sublime.Region(0, self.view.size()),
-    #         load_utf8(self.orig_src.name))
 
 def expanded_var(view, env_var):
     return sublime.expand_variables(env_var, 
@@ -2250,71 +3905,53 @@ def validate_title(view):
         dprint('No title meta data found!')
         return None
 
-    dprint("Filename: {}\nTitle: {}".format(
-        os.path.basename(view.file_name()), title))
+    dprint("Filename:", os.path.basename(view.file_name()), "Title:", title)
     return title
 
-def create_temporary_copy(view, preserve_ext=True):
-    '''
-    Copies the source file into a temporary file. Returns a
-    _TemporaryFileWrapper, whose destructor deletes the temp file (i.e. the
-    temp file is deleted when the object goes out of scope).
-    '''
-    tf_suffix=''
-    if preserve_ext:
-        if view.file_name() != None:
-            tf_suffix = splitext(view.file_name())[1]
-        else:
-            tf_suffix = 'None'
-    tf = NamedTemporaryFile(suffix=tf_suffix, delete=False)
-    save_utf8(tf.name, view.substr(sublime.Region(0, view.size())))
-    return tf
-
-def restore_temporary_copy(view, edit, tempFile):
-    '''Undo inline replacements. '''
-    view.replace(edit, sublime.Region(0, view.size()),
-        load_utf8(tempFile.name))
-
-def extract_code_blocks(view):
+def extract_code_blocks(text):
     '''
-    Extract all code blocks surrounded by ``` and return it's region
-    objects. If in a later step, some fancy code block ``` region intersect
+    Extract all code blocks surrounded by ``` and return their (begin, end)
+    offsets. If in a later step, some fancy code block ``` region intersect
     with the current processed PlantUML block region, skip inline processing
     of this intersecting UML block. As a result, the possibility for
     markdown fancy UML code blocks remains if no inline rendering is
     desired.
     '''
-    ctags = view.find_all('^```.*')
+    ctags = [m.span() for m in re.finditer(r'^```.*', text, re.MULTILINE)]
 
     # Check for even count of code block tags ```
     if len(ctags) % 2 != 0:
         dprint('Warning, odd number of code-block tags ``` found!')
         return []
 
-    return [sublime.Region.cover(
-        ctags[k], ctags[k+1]) for k in range(0, len(ctags), 2)]
+    return [(ctags[k][0], ctags[k+1][1]) for k in range(0, len(ctags), 2)]
 
-def extract_attrs(view, block, attr_prefix):
+def extract_attrs(text, pos, attr_prefix):
     '''
-    Extracts optional attributes (@...) if the @<_prefix>xyz matches attr_prefix.
+    Extracts optional attributes (@...) if the @<_prefix>xyz matches attr_prefix,
+    from the lines following the line ending at pos.
     Returns a tupel of sequential inline attributes as dict and their
-    regions as list object.
+    (begin, end) offsets as list object.
     '''
     attr_regs = []
     jattrsObj = dict()
 
-    # Find sequential related regions of @diag_ attribute lines
-
-    next_line = view.line(block.end()+1)
-    print(view.substr(next_line))
-    while attr_prefix in view.substr(next_line):
-        attr_regs.append(next_line)
-        next_line = view.line(attr_regs[len(attr_regs)-1].end()+1)
-
-    for attr in attr_regs:
+    # Find sequential related lines of @diag_ attributes
+    while pos < len(text):
+        begin = pos + 1
+        end = text.find('\n', begin)
+        if end == -1:
+            end = len(text)
+        dprint('attribute line:', text[begin:end])
+        if attr_prefix not in text[begin:end]:
+            break
+        attr_regs.append((begin, end))
+        pos = end
+
+    for begin, end in attr_regs:
         # Split attr into dict key and value
-        key=view.substr(attr).split(':', 1)[0].strip().replace(attr_prefix,'')
-        val=view.substr(attr).split(':', 1)[1].strip()
+        key=text[begin:end].split(':', 1)[0].strip().replace(attr_prefix,'')
+        val=text[begin:end].split(':', 1)[1].strip()
 
         # Check diagram attribute values for JSON compatibility.
         try:
@@ -2328,58 +3965,68 @@ def extract_attrs(view, block, attr_prefix):
 
     return jattrsObj, attr_regs
 
-def get_class_from_frame(fr):
-    args, _, _, value_dict = inspect.getargvalues(fr)
-    # we check the first parameter for the frame function is
-    # named 'self'
-    if len(args) and args[0] == 'self':
-        # in that case, 'self' will be referenced in value_dict
-        instance = value_dict.get('self', None)
-        if instance:
-            # return its class
-            return getattr(instance, '__class__', None)
-    # return None otherwise
-    return None
-
-def dprint(string, *args):
+class DebugLevels(object):
     '''
-    Verbose level configureable debug print methode. Inspects the call stack to
-    receive callers class name. Class dependent verbosity levels can be
-    configured via user settings file.
-    "debug_levels": { "<class name>": <level> }
+    Table of the "debug_levels" setting, resolved per calling function.
+    The table is rebuilt when the settings snapshot changes.
     '''
 
-    # frame = inspect.stack()[1][0]
-    # return
-    # print(get_class_from_frame(frame))
+    def __init__(self):
+        self.snapshot = None
+        self.levels = {}
+        self.callers = {}
+
+    def load(self, snapshot):
+        self.levels = snapshot.get('debug_levels') or {}
+        self.callers = {}
+        self.snapshot = snapshot
+
+    def resolve(self, frame):
+        ''' return (name, method, level) for the function running in frame '''
+        code = frame.f_code
+        instance = frame.f_locals.get('self') if code.co_varnames[:1] == ('self',) else None
+        # Inherited methods share their code object, so key on the class too
+        cls = instance.__class__ if instance is not None else None
+        caller = self.callers.get((code, cls))
+        if caller is None:
+            if cls is not None:
+                caller = (cls.__name__, code.co_name)
+            else:
+                caller = (code.co_name, code.co_name)
+            caller += (self.levels.get(caller[0], 0),)
+            self.callers[(code, cls)] = caller
+        return caller
 
-    try:
-        caller_class = inspect.stack()[1][0].f_locals["self"].__class__.__name__
-        caller_method = inspect.stack()[1][0].f_code.co_name
 
-        debug_levels = sublime.load_settings(
-            'MarkdownPreview.sublime-settings').get('debug_levels')
-        if not debug_levels or caller_class not in debug_levels.keys():
-            return
+debug_levels = DebugLevels()
 
-        # debug_levels={caller_class:2}
-
-        # Only print string from classes with debug level > 1
-        if debug_levels[caller_class] > 1:
-            print('[ {0!s}.{1!s} ]: {2!s}'.format(
-                caller_class,
-                caller_method,
-                string), end=' ')
-            if args:
-                for arg in args:
-                    print(arg, end=' ')
-            print(' ')
-    except:
-        if not args:
-            print('dprint except: ', string)
-        else:
-            print('dprint except: ' + string, args)
 
+def dprint(string, *args):
+    '''
+    Verbose level configureable debug print methode. Class dependent verbosity
+    levels can be configured via user settings file (functions outside of a
+    class use their function name).
+    "debug_levels": { "<class name>": <level> }
+
+    Nothing is formatted unless the caller's level is > 1, so pass values as
+    extra arguments instead of formatting them up front.
+    '''
+    snapshot = get_snapshot()
+    if snapshot is not debug_levels.snapshot:
+        debug_levels.load(snapshot)
+    if not debug_levels.levels:
+        return
+
+    frame = sys._getframe(1)
+    caller = debug_levels.resolve(frame)
+    del frame
+
+    # Only print string from classes with debug level > 1
+    if caller[2] > 1:
+        print(' '.join(
+            ['[ {0!s}.{1!s} ]: {2!s}'.format(caller[0], caller[1], string)] +
+            ['{0!s}'.format(arg) for arg in args]
+        ))
 
 
     # def query_export_dir(self):
@@ -20,6 +20,7 @@ from __future__ import unicode_literals
 from . import Extension
 from .. import util
 from ..treeprocessors import Treeprocessor
+import re
 
 try:
     from pygments import highlight
@@ -29,6 +30,113 @@ try:
 except ImportError:
     pygments = False
 
+# Maximum number of entries kept in each of the module level caches below.
+CACHE_SIZE = 512
+# Number of characters of an unlabeled block that are used for language guessing.
+GUESS_SAMPLE = 2048
+
+RE_SHEBANG = re.compile(
+    r'^#!\s*(?:[^\s]*/)?(?:env[ \t]+(?:-[^\s]*[ \t]+)*)?(?P<interp>[\w.+-]+)'
+)
+RE_VERSION = re.compile(r'[\d.]+$')
+
+RE_HEADER = re.compile(r'''
+    (?:(?:^::+)|(?P<shebang>^[#]!)) # Shebang or 2 or more colons
+    (?P<path>(?:/\w+)*[/ ])?        # Zero or 1 path
+    (?P<lang>[\w+-]*)               # The language
+    \s*                             # Arbitrary whitespace
+    # Optional highlight lines, single- or double-quote-delimited
+    (hl_lines=(?P<quot>"|')(?P<hl_lines>.*?)(?P=quot))?
+    ''', re.VERBOSE)
+
+# Cheap content signatures checked before handing a sample to Pygments.
+CONTENT_HINTS = (
+    (re.compile(r'^\s*<\?php'), 'php'),
+    (re.compile(r'^\s*<\?xml'), 'xml'),
+    (re.compile(r'^\s*<!DOCTYPE\s+html|^\s*<html[\s>]', re.I), 'html'),
+    (re.compile(r'^(?:diff --git |Index: |--- .*\n\+\+\+ )'), 'diff')
+)
+
+_lexer_cache = {}
+_formatter_cache = {}
+_guess_cache = {}
+
+
+def _cache_store(cache, key, value):
+    """Store a value in one of the module caches, flushing it when full."""
+
+    if len(cache) >= CACHE_SIZE:
+        cache.clear()
+    cache[key] = value
+    return value
+
+
+def get_lexer(name, **options):
+    """
+    Return a (shared) lexer instance for the given name.
+
+    Names that are not a Pygments alias are remembered too, so the plugin
+    lookup is not repeated.  Returns None if no lexer could be found.
+    """
+
+    if not name:
+        return None
+    key = (name.lower(), tuple(sorted(options.items())))
+    if key in _lexer_cache:
+        return _lexer_cache[key]
+    try:
+        lexer = get_lexer_by_name(name, **options)
+    except ValueError:
+        lexer = None
+    return _cache_store(_lexer_cache, key, lexer)
+
+
+def get_formatter(name, **options):
+    """Return a (shared) formatter instance for the given name and options."""
+
+    key = (name, tuple(sorted(options.items())))
+    formatter = _formatter_cache.get(key)
+    if formatter is None:
+        formatter = _cache_store(_formatter_cache, key, get_formatter_by_name(name, **options))
+    return formatter
+
+
+def detect_lexer(src):
+    """
+    Try to find a lexer for a block without a (known) language.
+
+    Cheap checks come first: an interpreter shebang and a few well known
+    content signatures.  Only then is Pygments' `guess_lexer` run, and only
+    over a bounded sample of the block.  Guesses are cached by sample so
+    repeated renders of the same block never sweep all lexers again.
+    Returns None if nothing could be detected.
+    """
+
+    m = RE_SHEBANG.match(src)
+    if m:
+        interp = m.group('interp')
+        lexer = get_lexer(interp)
+        if lexer is None:
+            lexer = get_lexer(RE_VERSION.sub('', interp))
+        if lexer is not None:
+            return lexer
+
+    sample = src[:GUESS_SAMPLE]
+    if len(src) > GUESS_SAMPLE and '\n' in sample:
+        sample = sample[:sample.rindex('\n')]
+
+    for pattern, name in CONTENT_HINTS:
+        if pattern.match(sample):
+            return get_lexer(name)
+
+    if sample in _guess_cache:
+        return _guess_cache[sample]
+    try:
+        lexer = guess_lexer(sample)
+    except ValueError:
+        lexer = None
+    return _cache_store(_guess_cache, sample, lexer)
+
 
 def parse_hl_lines(expr):
     """Support our syntax for emphasizing certain lines of code.
@@ -45,6 +153,41 @@ def parse_hl_lines(expr):
         return []
 
 
+class HighlightBudget(object):
+    """
+    Limit how much code is handed to Pygments for one document.
+
+    Blocks with more than `max_lines` lines or `max_bytes` bytes, and all
+    blocks once `max_total_bytes` bytes have been highlighted, are rendered
+    without Pygments instead.  A value of 0 disables the respective limit.
+    `downgraded` counts the blocks that were refused.
+    """
+
+    def __init__(self, max_lines=0, max_bytes=0, max_total_bytes=0):
+        self.max_lines = int(max_lines or 0)
+        self.max_bytes = int(max_bytes or 0)
+        self.max_total_bytes = int(max_total_bytes or 0)
+        self.reset()
+
+    def reset(self):
+        """ Start a new document. """
+        self.total_bytes = 0
+        self.downgraded = 0
+
+    def allow(self, src):
+        """ Return whether `src` may still be highlighted with Pygments. """
+        size = len(src.encode('utf-8'))
+        if (
+            (self.max_lines and src.count('\n') + 1 > self.max_lines) or
+            (self.max_bytes and size > self.max_bytes) or
+            (self.max_total_bytes and self.total_bytes + size > self.max_total_bytes)
+        ):
+            self.downgraded += 1
+            return False
+        self.total_bytes += size
+        return True
+
+
 # ------------------ The Main CodeHilite Class ----------------------
 class CodeHilite(object):
     """
@@ -66,6 +209,9 @@ class CodeHilite(object):
 
     * hl_lines: (List of integers) Lines to emphasize, 1-indexed.
 
+    * budget: (HighlightBudget) Optional size limits; blocks over the
+      budget are rendered as if `use_pygments` was off.
+
     Low Level Usage:
         >>> code = CodeHilite()
         >>> code.src = 'some text' # String or anything with a .readline attr.
@@ -76,7 +222,8 @@ class CodeHilite(object):
 
     def __init__(self, src=None, linenums=None, guess_lang=True,
                  css_class="codehilite", lang=None, style='default',
-                 noclasses=False, tab_length=4, hl_lines=None, use_pygments=True):
+                 noclasses=False, tab_length=4, hl_lines=None, use_pygments=True,
+                 budget=None):
         self.src = src
         self.lang = lang
         self.linenums = linenums
@@ -87,6 +234,7 @@ class CodeHilite(object):
         self.tab_length = tab_length
         self.hl_lines = hl_lines or []
         self.use_pygments = use_pygments
+        self.budget = budget
 
     def hilite(self):
         """
@@ -104,23 +252,21 @@ class CodeHilite(object):
         if self.lang is None:
             self._parseHeader()
 
-        if pygments and self.use_pygments:
-            try:
-                lexer = get_lexer_by_name(self.lang)
-            except ValueError:
-                try:
-                    if self.guess_lang:
-                        lexer = guess_lexer(self.src)
-                    else:
-                        lexer = get_lexer_by_name('text')
-                except ValueError:
-                    lexer = get_lexer_by_name('text')
-            formatter = get_formatter_by_name('html',
-                                              linenos=self.linenums,
-                                              cssclass=self.css_class,
-                                              style=self.style,
-                                              noclasses=self.noclasses,
-                                              hl_lines=self.hl_lines)
+        if (
+            pygments and self.use_pygments and
+            (self.budget is None or self.budget.allow(self.src))
+        ):
+            lexer = get_lexer(self.lang)
+            if lexer is None and self.guess_lang:
+                lexer = detect_lexer(self.src)
+            if lexer is None:
+                lexer = get_lexer('text')
+            formatter = get_formatter('html',
+                                      linenos=self.linenums,
+                                      cssclass=self.css_class,
+                                      style=self.style,
+                                      noclasses=self.noclasses,
+                                      hl_lines=tuple(self.hl_lines))
             return highlight(self.src, lexer, formatter)
         else:
             # just escape and build markup usable by JS highlighting libs
@@ -157,23 +303,13 @@ class CodeHilite(object):
             :::python hl_lines="1 3"
         """
 
-        import re
-
         # split text into lines
         lines = self.src.split("\n")
         # pull first line to examine
         fl = lines.pop(0)
 
-        c = re.compile(r'''
-            (?:(?:^::+)|(?P<shebang>^[#]!)) # Shebang or 2 or more colons
-            (?P<path>(?:/\w+)*[/ ])?        # Zero or 1 path
-            (?P<lang>[\w+-]*)               # The language
-            \s*                             # Arbitrary whitespace
-            # Optional highlight lines, single- or double-quote-delimited
-            (hl_lines=(?P<quot>"|')(?P<hl_lines>.*?)(?P=quot))?
-            ''',  re.VERBOSE)
         # search first line for shebang
-        m = c.search(fl)
+        m = RE_HEADER.search(fl)
         if m:
             # we have a match
             try:
@@ -214,7 +350,8 @@ class HiliteTreeprocessor(Treeprocessor):
                     style=self.config['pygments_style'],
                     noclasses=self.config['noclasses'],
                     tab_length=self.markdown.tab_length,
-                    use_pygments=self.config['use_pygments']
+                    use_pygments=self.config['use_pygments'],
+                    budget=self.budget
                 )
                 placeholder = self.markdown.htmlStash.store(code.hilite(),
                                                             safe=True)
@@ -248,19 +385,38 @@ class CodeHiliteExtension(Extension):
             'use_pygments': [True,
                              'Use Pygments to Highlight code blocks. '
                              'Disable if using a JavaScript library. '
-                             'Default: True']
+                             'Default: True'],
+            'max_lines': [0,
+                          'Do not use Pygments for blocks with more lines '
+                          'than this - Default: 0 (no limit)'],
+            'max_bytes': [0,
+                          'Do not use Pygments for blocks larger than this '
+                          '- Default: 0 (no limit)'],
+            'max_total_bytes': [0,
+                                'Stop using Pygments once this many bytes '
+                                'were highlighted in a document - '
+                                'Default: 0 (no limit)']
             }
 
         super(CodeHiliteExtension, self).__init__(*args, **kwargs)
 
     def extendMarkdown(self, md, md_globals):
         """ Add HilitePostprocessor to Markdown instance. """
+        config = self.getConfigs()
+        self.budget = HighlightBudget(
+            config['max_lines'], config['max_bytes'], config['max_total_bytes']
+        )
         hiliter = HiliteTreeprocessor(md)
-        hiliter.config = self.getConfigs()
+        hiliter.config = config
+        hiliter.budget = self.budget
         md.treeprocessors.add("hilite", hiliter, "<inline")
 
         md.registerExtension(self)
 
+    def reset(self):
+        """ Reset the highlight budget for a new document. """
+        self.budget.reset()
+
 
 def makeExtension(*args, **kwargs):
     return CodeHiliteExtension(*args, **kwargs)
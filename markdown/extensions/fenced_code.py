@@ -51,6 +51,7 @@ class FencedBlockPreprocessor(Preprocessor):
 
         self.checked_for_codehilite = False
         self.codehilite_conf = {}
+        self.codehilite_budget = None
 
     def run(self, lines):
         """ Match and store Fenced Code Blocks in the HtmlStash. """
@@ -60,6 +61,7 @@ class FencedBlockPreprocessor(Preprocessor):
             for ext in self.markdown.registeredExtensions:
                 if isinstance(ext, CodeHiliteExtension):
                     self.codehilite_conf = ext.config
+                    self.codehilite_budget = ext.budget
                     break
 
             self.checked_for_codehilite = True
@@ -83,7 +85,8 @@ class FencedBlockPreprocessor(Preprocessor):
                         style=self.codehilite_conf['pygments_style'][0],
                         lang=(m.group('lang') or None),
                         noclasses=self.codehilite_conf['noclasses'][0],
-                        hl_lines=parse_hl_lines(m.group('hl_lines'))
+                        hl_lines=parse_hl_lines(m.group('hl_lines')),
+                        budget=self.codehilite_budget
                     )
 
                     code = highliter.hilite()
@@ -17,6 +17,7 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 from . import Extension
 from ..preprocessors import Preprocessor
+from ..blockprocessors import BlockProcessor
 from ..inlinepatterns import Pattern
 from ..treeprocessors import Treeprocessor
 from ..postprocessors import Postprocessor
@@ -65,6 +66,10 @@ class FootnoteExtension(Extension):
         md.preprocessors.add(
             "footnote", FootnotePreprocessor(self), "<reference"
         )
+        # Insert a block processor that records the place marker paragraph
+        md.parser.blockprocessors.add(
+            "footnote_placeholder", FootnotePlaceholderProcessor(self), "<paragraph"
+        )
         # Insert an inline pattern before ImageReferencePattern
         FOOTNOTE_RE = r'\[\^([^\]]*)\]'  # blah blah [^1] blah
         md.inlinePatterns.add(
@@ -84,8 +89,32 @@ class FootnoteExtension(Extension):
     def reset(self):
         """ Clear footnotes on reset, and prepare for distinct document. """
         self.footnotes = OrderedDict()
+        self.footnote_numbers = {}
+        self.placeholder = None
+        self.placeholder_count = 0
+        self.marker_count = 0
         self.unique_prefix += 1
 
+    def setFootnotesPlaceholder(self, child, parent):
+        """ Remember a paragraph consisting of only the place marker. """
+        if self.placeholder is None:
+            self.placeholder = (child, parent, True)
+        self.placeholder_count += 1
+
+    def getFootnotesPlaceholder(self, root):
+        """
+        Return the Footnote placeholder found while parsing.
+
+        The placeholder paragraph recorded by the block parser is used when
+        every place marker in the source was such a paragraph.  Otherwise the
+        tree is searched as the marker can be anywhere in the text.
+        """
+        if not self.marker_count:
+            return None
+        if self.placeholder is not None and self.placeholder_count == self.marker_count:
+            return self.placeholder
+        return self.findFootnotesPlaceholder(root)
+
     def findFootnotesPlaceholder(self, root):
         """ Return ElementTree Element that contains Footnote placeholder. """
         def finder(element):
@@ -106,8 +135,14 @@ class FootnoteExtension(Extension):
 
     def setFootnote(self, id, text):
         """ Store a footnote for later retrieval. """
+        if id not in self.footnote_numbers:
+            self.footnote_numbers[id] = len(self.footnote_numbers) + 1
         self.footnotes[id] = text
 
+    def getFootnoteNumber(self, id):
+        """ Return the (1 based) number of a footnote, or None if it is unknown. """
+        return self.footnote_numbers.get(id)
+
     def get_separator(self):
         if self.md.output_format in ['html5', 'xhtml5']:
             return '-'
@@ -131,7 +166,7 @@ class FootnoteExtension(Extension):
     def makeFootnotesDiv(self, root):
         """ Return div of footnotes as et Element. """
 
-        if not list(self.footnotes.keys()):
+        if not self.footnotes:
             return None
 
         div = etree.Element("div")
@@ -139,7 +174,7 @@ class FootnoteExtension(Extension):
         etree.SubElement(div, "hr")
         ol = etree.SubElement(div, "ol")
 
-        for id in self.footnotes.keys():
+        for id in self.footnotes:
             li = etree.SubElement(ol, "li")
             li.set("id", self.makeFootnoteId(id))
             self.parser.parseChunk(li, self.footnotes[id])
@@ -151,11 +186,11 @@ class FootnoteExtension(Extension):
             backlink.set(
                 "title",
                 "Jump back to footnote %d in the text" %
-                (self.footnotes.index(id)+1)
+                self.getFootnoteNumber(id)
             )
             backlink.text = FN_BACKLINK_TEXT
 
-            if li.getchildren():
+            if len(li):
                 node = li[-1]
                 if node.tag == "p":
                     node.text = node.text + NBSP_PLACEHOLDER
@@ -184,15 +219,18 @@ class FootnotePreprocessor(Preprocessor):
 
         """
         newlines = []
+        marker = self.footnotes.getConfig("PLACE_MARKER")
         i = 0
         while True:
             m = DEF_RE.match(lines[i])
             if m:
-                fn, _i = self.detectTabbed(lines[i+1:])
+                fn, _i = self.detectTabbed(lines, i+1)
                 fn.insert(0, m.group(2))
                 i += _i-1  # skip past footnote
                 self.footnotes.setFootnote(m.group(1), "\n".join(fn))
             else:
+                if marker in lines[i]:
+                    self.footnotes.marker_count += lines[i].count(marker)
                 newlines.append(lines[i])
             if len(lines) > i+1:
                 i += 1
@@ -200,12 +238,13 @@ class FootnotePreprocessor(Preprocessor):
                 break
         return newlines
 
-    def detectTabbed(self, lines):
+    def detectTabbed(self, lines, start=0):
         """ Find indented text and remove indent before further proccesing.
 
         Keyword arguments:
 
         * lines: an array of strings
+        * start: index of the first line to examine
 
         Returns: a list of post processed items and the index of last line.
 
@@ -219,7 +258,8 @@ class FootnotePreprocessor(Preprocessor):
             if match:
                 return match.group(4)
 
-        for line in lines:
+        for index in range(start, len(lines)):
+            line = lines[index]
             if line.strip():  # Non-blank line
                 detabbed_line = detab(line)
                 if detabbed_line:
@@ -239,7 +279,7 @@ class FootnotePreprocessor(Preprocessor):
                 i += 1  # advance
 
                 # Find the next non-blank line
-                for j in range(i, len(lines)):
+                for j in range(start + i, len(lines)):
                     if lines[j].strip():
                         next_line = lines[j]
                         break
@@ -258,6 +298,26 @@ class FootnotePreprocessor(Preprocessor):
         return items, i
 
 
+class FootnotePlaceholderProcessor(BlockProcessor):
+    """ Record paragraphs that consist of the place marker while parsing. """
+
+    def __init__(self, footnotes):
+        super(FootnotePlaceholderProcessor, self).__init__(footnotes.parser)
+        self.footnotes = footnotes
+
+    def test(self, parent, block):
+        return (
+            not self.parser.state.isstate('list') and
+            block.strip() == self.footnotes.getConfig("PLACE_MARKER")
+        )
+
+    def run(self, parent, blocks):
+        block = blocks.pop(0)
+        p = etree.SubElement(parent, 'p')
+        p.text = block.lstrip()
+        self.footnotes.setFootnotesPlaceholder(p, parent)
+
+
 class FootnotePattern(Pattern):
     """ InlinePattern for footnote markers in a document's body text. """
 
@@ -267,7 +327,8 @@ class FootnotePattern(Pattern):
 
     def handleMatch(self, m):
         id = m.group(2)
-        if id in self.footnotes.footnotes.keys():
+        number = self.footnotes.getFootnoteNumber(id)
+        if number is not None:
             sup = etree.Element("sup")
             a = etree.SubElement(sup, "a")
             sup.set('id', self.footnotes.makeFootnoteRefId(id))
@@ -275,7 +336,7 @@ class FootnotePattern(Pattern):
             if self.footnotes.md.output_format not in ['html5', 'xhtml5']:
                 a.set('rel', 'footnote')  # invalid in HTML5
             a.set('class', 'footnote-ref')
-            a.text = text_type(self.footnotes.footnotes.index(id) + 1)
+            a.text = text_type(number)
             return sup
         else:
             return None
@@ -290,10 +351,10 @@ class FootnoteTreeprocessor(Treeprocessor):
     def run(self, root):
         footnotesDiv = self.footnotes.makeFootnotesDiv(root)
         if footnotesDiv is not None:
-            result = self.footnotes.findFootnotesPlaceholder(root)
+            result = self.footnotes.getFootnotesPlaceholder(root)
             if result:
                 child, parent, isText = result
-                ind = parent.getchildren().index(child)
+                ind = list(parent).index(child)
                 if isText:
                     parent.remove(child)
                     parent.insert(ind, footnotesDiv)
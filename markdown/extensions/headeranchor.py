@@ -31,7 +31,7 @@ import unicodedata
 import re
 import sys
 from .. import util
-from .toc import slugify, stashedHTML2text, unique, TocExtension
+from .toc import slugify, get_slug_allocator, memoize_slugify, TocExtension
 
 PY3 = sys.version_info >= (3, 0) and sys.version_info < (4, 0)
 
@@ -54,6 +54,7 @@ RE_TAGS = re.compile(r'''</?[^>]*>''', re.UNICODE)
 RE_WORD = re.compile(r'''[^\w\- ]''', re.UNICODE)
 
 
+@memoize_slugify
 def uslugify(text, sep):
     """Unicode slugify (utf-8)."""
 
@@ -65,6 +66,7 @@ def uslugify(text, sep):
     return RE_WORD.sub('', tag_id).replace(' ', sep)
 
 
+@memoize_slugify
 def uslugify_encoded(text, sep):
     """Custom slugify (percent encoded)."""
 
@@ -108,19 +110,15 @@ class HeaderAnchorTreeprocessor(Treeprocessor):
 
         self.get_settings()
 
-        # Get a list of id attributes
-        used_ids = set()
-        for tag in util.iterate(root):
-            if "id" in tag.attrib:
-                used_ids.add(tag.attrib["id"])
+        # Get the allocator that knows the used id attributes
+        slugs = get_slug_allocator(self.markdown, root)
 
         for tag in util.iterate(root):
             if tag.tag in ('h1', 'h2', 'h3', 'h4', 'h5', 'h6'):
                 if "id" in tag.attrib:
                     id_attr = tag.get('id')
                 else:
-                    id_attr = stashedHTML2text(''.join(util.itertext(tag)), self.md)
-                    id_attr = unique(self.slugify(id_attr, self.separator), used_ids)
+                    id_attr = slugs.unique(self.slugify(slugs.header_text(tag), self.separator))
                     tag.set('id', id_attr)
                 tag.text = self.markdown.htmlStash.store(
                     LINK % {"id": id_attr},
@@ -19,8 +19,8 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 from . import Extension
 from ..treeprocessors import Treeprocessor
-from ..util import parseBoolValue, itertext
-from .toc import slugify, unique, stashedHTML2text
+from ..util import parseBoolValue
+from .toc import slugify, get_slug_allocator
 import warnings
 
 
@@ -33,15 +33,19 @@ class HeaderIdTreeprocessor(Treeprocessor):
         start_level, force_id = self._get_meta()
         slugify = self.config['slugify']
         sep = self.config['separator']
+        slugs = get_slug_allocator(self.md, doc)
         for elem in doc:
             if elem.tag in ['h1', 'h2', 'h3', 'h4', 'h5', 'h6']:
                 if force_id:
-                    if "id" in elem.attrib:
-                        id = elem.get('id')
+                    if "id" not in elem.attrib:
+                        id = slugs.unique(slugify(slugs.header_text(elem), sep))
+                    elif elem.get('id') in self.IDs:
+                        # An explicit id already used by a header
+                        id = slugs.unique(elem.get('id'))
                     else:
-                        id = stashedHTML2text(''.join(itertext(elem)), self.md)
-                        id = slugify(id, sep)
-                    elem.set('id', unique(id, self.IDs))
+                        id = elem.get('id')
+                    self.IDs.add(id)
+                    elem.set('id', id)
                 if start_level:
                     level = int(elem.tag[-1]) + start_level
                     if level > 6:
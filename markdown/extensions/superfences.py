@@ -223,6 +223,8 @@ class SuperFencesBlockPreprocessor(Preprocessor):
     """
 
     fence_start = re.compile(NESTED_FENCE_START)
+    fence_end_cache = {}
+    whitespace_cache = {}
     CODE_WRAP = '<pre><code%s>%s</code></pre>'
     CLASS_ATTR = ' class="%s"'
 
@@ -233,6 +235,7 @@ class SuperFencesBlockPreprocessor(Preprocessor):
         self.markdown = md
         self.checked_for_codehilite = False
         self.codehilite_conf = {}
+        self.codehilite_budget = None
 
     def rebuild_block(self, lines):
         """Deindent the fenced block lines."""
@@ -246,9 +249,28 @@ class SuperFencesBlockPreprocessor(Preprocessor):
             for ext in self.markdown.registeredExtensions:
                 if isinstance(ext, CodeHiliteExtension):
                     self.codehilite_conf = ext.config
+                    self.codehilite_budget = ext.budget
                     break
             self.checked_for_codehilite = True
 
+    def get_fence_end(self, fence):
+        """Get the (cached) pattern that closes the given fence."""
+
+        pattern = self.fence_end_cache.get(fence)
+        if pattern is None:
+            pattern = re.compile(NESTED_FENCE_END % fence)
+            self.fence_end_cache[fence] = pattern
+        return pattern
+
+    def get_whitespace(self, ws_len):
+        """Get the (cached) pattern that splits off up to `ws_len` indentation characters."""
+
+        pattern = self.whitespace_cache.get(ws_len)
+        if pattern is None:
+            pattern = re.compile(WS % ws_len)
+            self.whitespace_cache[ws_len] = pattern
+        return pattern
+
     def clear(self):
         """Reset the class variables."""
 
@@ -347,7 +369,10 @@ class SuperFencesBlockPreprocessor(Preprocessor):
         for line in lines:
             if self.fence is None:
                 # Found the start of a fenced block.
-                m = self.fence_start.match(line)
+                if '```' not in line and '~~~' not in line:
+                    m = None
+                else:
+                    m = self.fence_start.match(line)
                 if m is not None:
                     start = count
                     self.first = m.group(0)
@@ -358,8 +383,8 @@ class SuperFencesBlockPreprocessor(Preprocessor):
                     self.fence = m.group('fence')
                     self.lang = m.group('lang')
                     self.hl_lines = m.group('hl_lines')
-                    self.fence_end = re.compile(NESTED_FENCE_END % self.fence)
-                    self.whitespace = re.compile(WS % self.ws_len)
+                    self.fence_end = self.get_fence_end(self.fence)
+                    self.whitespace = self.get_whitespace(self.ws_len)
             else:
                 # Evaluate lines
                 # - Determine if it is the ending line or content line
@@ -390,11 +415,19 @@ class SuperFencesBlockPreprocessor(Preprocessor):
 
         # Now that we are done iterating the lines,
         # let's replace the original content with the
-        # fenced blocks.
-        while len(self.stack):
-            fenced, start, end = self.stack.pop()
-            lines = lines[:start] + [fenced] + lines[end:]
-        return lines
+        # fenced blocks.  The blocks are stored in order
+        # and never overlap, so one pass is enough.
+        if not self.stack:
+            return lines
+        new_lines = []
+        pos = 0
+        for fenced, start, end in self.stack:
+            new_lines.extend(lines[pos:start])
+            new_lines.append(fenced)
+            pos = end
+        new_lines.extend(lines[pos:])
+        self.stack = []
+        return new_lines
 
     def highlight(self, source, language):
         """
@@ -413,7 +446,8 @@ class SuperFencesBlockPreprocessor(Preprocessor):
                 lang=language,
                 noclasses=self.codehilite_conf['noclasses'][0],
                 hl_lines=parse_hl_lines(self.hl_lines),
-                use_pygments=self.codehilite_conf['use_pygments'][0]
+                use_pygments=self.codehilite_conf['use_pygments'][0],
+                budget=self.codehilite_budget
             ).hilite()
         else:
             lang = self.CLASS_ATTR % language if language else ''
@@ -19,14 +19,35 @@ from . import Extension
 from ..treeprocessors import Treeprocessor
 from ..util import etree, parseBoolValue, AMP_SUBSTITUTE, HTML_PLACEHOLDER_RE, string_type, iterate, \
     itertext
+from functools import wraps
 import re
 import unicodedata
 
+SLUG_CACHE_SIZE = 1024
+SLUG_STRIP_RE = re.compile(r'[^\w\s-]')
 
+
+def memoize_slugify(func):
+    """ Cache the results of a slugify callable per (text, separator). """
+    cache = {}
+
+    @wraps(func)
+    def cached(value, separator):
+        key = (value, separator)
+        slug = cache.get(key)
+        if slug is None:
+            if len(cache) >= SLUG_CACHE_SIZE:
+                cache.clear()
+            slug = cache[key] = func(value, separator)
+        return slug
+    return cached
+
+
+@memoize_slugify
 def slugify(value, separator):
     """ Slugify a string, to make it URL friendly. """
     value = unicodedata.normalize('NFKD', value).encode('ascii', 'ignore')
-    value = re.sub('[^\w\s-]', '', value.decode('ascii')).strip().lower()
+    value = SLUG_STRIP_RE.sub('', value.decode('ascii')).strip().lower()
     return re.sub('[%s\s]+' % separator, separator, value)
 
 
@@ -45,6 +66,83 @@ def unique(id, ids):
     return id
 
 
+class SlugAllocator(object):
+    """
+    Hand out unique ids for the headers of one document.
+
+    Gives the same results as `unique`, but remembers per base id which
+    numbered suffixes are already taken so that many headers with the same
+    text do not probe every `_1`, `_2`, ... suffix again.  The allocator is
+    shared by the toc, headerid and headeranchor extensions (see
+    `get_slug_allocator`), which also share the header texts it computes.
+    """
+
+    def __init__(self, doc, md):
+        self.doc = doc
+        self.md = md
+        self.ids = set()
+        self.texts = {}
+        # base -> (low, high): every `base_n` with low <= n < high is taken
+        self.counters = {}
+        self.collect()
+
+    def collect(self):
+        """ Mark the ids in the document as used, other processors may have added some. """
+        for el in iterate(self.doc):
+            if "id" in el.attrib:
+                self.ids.add(el.attrib["id"])
+
+    def add(self, id):
+        """ Mark an id as used. """
+        self.ids.add(id)
+
+    def header_text(self, el):
+        """ Return the plain text of a header, to be slugified. """
+        text = self.texts.get(el)
+        if text is None:
+            text = self.texts[el] = stashedHTML2text(''.join(itertext(el)).strip(), self.md)
+        return text
+
+    def unique(self, id):
+        """ Ensure id is unique in the document. Append '_1', '_2'... if not """
+        if id and id not in self.ids:
+            self.ids.add(id)
+            return id
+
+        m = IDCOUNT_RE.match(id)
+        if m:
+            base, start = m.group(1), int(m.group(2)) + 1
+        else:
+            base, start = id, 1
+        low, high = self.counters.get(base, (start, start))
+
+        n = start
+        while True:
+            if low <= n < high:
+                n = high
+            id = '%s_%d' % (base, n)
+            if id not in self.ids:
+                break
+            n += 1
+
+        if start <= high and n + 1 >= low:
+            self.counters[base] = (min(low, start), max(high, n + 1))
+        else:
+            self.counters[base] = (start, n + 1)
+        self.ids.add(id)
+        return id
+
+
+def get_slug_allocator(md, doc):
+    """ Return the slug allocator shared by all header processors for `doc`. """
+    slugs = getattr(md, 'header_slugs', None)
+    if slugs is None or slugs.doc is not doc:
+        slugs = md.header_slugs = SlugAllocator(doc, md)
+    else:
+        slugs.collect()
+    return slugs
+
+
 def stashedHTML2text(text, md):
     """ Extract raw HTML from stash, reduce to plain text and swap with placeholder. """
     def _html_sub(m):
@@ -224,11 +322,8 @@ class TocTreeprocessor(Treeprocessor):
         return div
 
     def run(self, doc):
-        # Get a list of id attributes
-        used_ids = set()
-        for el in iterate(doc):
-            if "id" in el.attrib:
-                used_ids.add(el.attrib["id"])
+        # Get the allocator that knows the used id attributes
+        slugs = get_slug_allocator(self.markdown, doc)
 
         toc_tokens = []
         for el in iterate(doc):
@@ -238,8 +333,7 @@ class TocTreeprocessor(Treeprocessor):
 
                 # Do not override pre-existing ids
                 if "id" not in el.attrib:
-                    innertext = stashedHTML2text(text, self.markdown)
-                    el.attrib["id"] = unique(self.slugify(innertext, self.sep), used_ids)
+                    el.attrib["id"] = slugs.unique(self.slugify(slugs.header_text(el), self.sep))
 
                 toc_tokens.append({
                     'level': int(el.tag[-1]),
@@ -1,5 +1,8 @@
 from __future__ import unicode_literals
 import sublime
+import codecs
+import copy
+import fnmatch
 import os
 import sys
 import re
@@ -13,10 +16,89 @@ else:
     unicode_str = unicode
 
 
+SETTINGS_FILE = 'MarkdownPreview.sublime-settings'
+RE_KEY = re.compile(r'"((?:[^"\\]|\\.)*)"\s*:')
+_snapshots = {}
+
+
+def get_settings_keys(settings_file):
+    """
+    Return the names of the keys found in the settings files named like
+    settings_file: the defaults and the platform and user files.
+
+    Sublime can't list the keys of a settings object, so they are taken
+    from the files.  Keys of nested objects are included too, looking them
+    up is harmless.
+    """
+    pattern = '%s*%s' % os.path.splitext(settings_file)
+    texts = []
+    if hasattr(sublime, 'find_resources'):
+        for resource in sublime.find_resources(pattern):
+            try:
+                texts.append(sublime.load_resource(resource))
+            except Exception:
+                pass
+    else:
+        for root, dirs, files in os.walk(sublime.packages_path()):
+            for name in fnmatch.filter(files, pattern):
+                try:
+                    with codecs.open(os.path.join(root, name), 'r', encoding='utf-8') as f:
+                        texts.append(f.read())
+                except (IOError, OSError, UnicodeDecodeError):
+                    pass
+    keys = set()
+    for text in texts:
+        keys.update(RE_KEY.findall(text))
+    return keys
+
+
+class SettingsSnapshot(object):
+    """
+    Frozen copy of a sublime settings file.
+
+    Every key is read from sublime once, when the snapshot is taken, so a
+    render sees the values it started with and lookups are plain dict
+    accesses instead of calls into the host.  Values are shared, callers
+    must copy lists and dicts before modifying them.
+    """
+
+    def __init__(self, settings, keys=()):
+        if hasattr(settings, 'to_dict'):
+            self._values = settings.to_dict()
+        else:
+            self._values = dict((key, settings.get(key)) for key in keys if settings.has(key))
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+    def has(self, key):
+        return key in self._values
+
+
+def get_snapshot(settings_file=SETTINGS_FILE):
+    """
+    Return the current snapshot of a settings file.
+
+    The same snapshot is shared until the settings change on disk; a render
+    that holds on to a snapshot keeps seeing the values it started with.
+    """
+    snapshot = _snapshots.get(settings_file)
+    if snapshot is None:
+        settings = sublime.load_settings(settings_file)
+        settings.clear_on_change('markdown_settings_snapshot')
+        settings.add_on_change(
+            'markdown_settings_snapshot', lambda: _snapshots.pop(settings_file, None)
+        )
+        snapshot = _snapshots[settings_file] = SettingsSnapshot(
+            settings, get_settings_keys(settings_file)
+        )
+    return snapshot
+
+
 class Settings(object):
-    def __init__(self, settings_file, file_name):
+    def __init__(self, settings_file, file_name, snapshot=None):
         self.file_name = file_name
-        self._sub_settings = sublime.load_settings(settings_file)
+        self._sub_settings = get_snapshot(settings_file) if snapshot is None else snapshot
         self._overrides = {
             "builtin": {
                 "references": [],
@@ -100,6 +182,14 @@ class Settings(object):
 
         return basepath
 
+    def get_overrides(self):
+        """ Return a copy of the overrides collected while compiling """
+        return copy.deepcopy(self._overrides)
+
+    def set_overrides(self, overrides):
+        """ Replace the overrides with ones returned by get_overrides """
+        self._overrides = copy.deepcopy(overrides)
+
     def add_meta(self, meta):
         meta = dict(list(meta.items()) + list(self._overrides.get("meta", {}).items()))
         self._overrides["meta"] = meta
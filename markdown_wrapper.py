@@ -59,7 +59,7 @@ class StMarkdown(Markdown):
         if pos > 0:
             ext_args = ext_name[pos + 1:-1]
             ext_name = ext_name[:pos]
-            pairs = [x.split("=") for x in ext_args.split(",")]
+            pairs = [x.split("=") for x in ext_args.split(",") if x.strip()]
             configs.update([(x.strip(), y.strip()) for (x, y) in pairs])
 
         # Setup the module name